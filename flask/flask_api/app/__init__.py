@@ -1,20 +1,39 @@
 from config import config
 from flask import Flask
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
+from .database import Database
+from .cache import CredentialCache, ResponseCache
+from .metrics import Metrics
+from .search import SearchIndex
+from .availability import Availability
+from .images import ImageStore
 
 
-db = SQLAlchemy()
+db = Database()
 login_manager = LoginManager()
+credential_cache = CredentialCache()
+response_cache = ResponseCache()
+metrics = Metrics()
+search_index = SearchIndex(db)
+availability = Availability(db)
+image_store = ImageStore(db)
 
 
 def create_app(config_name):
     app = Flask(__name__)
 
     app.config.from_object(config[config_name])
+    if not app.config.get('SECRET_KEY'):
+        raise RuntimeError('SECRET_KEY is not set')
 
     db.init_app(app)
     login_manager.init_app(app)
+    credential_cache.init_app(app)
+    response_cache.init_app(app)
+    metrics.init_app(app)
+    search_index.init_app(app)
+    availability.init_app(app)
+    image_store.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
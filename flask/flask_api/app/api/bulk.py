@@ -0,0 +1,120 @@
+from .. import db
+from .streaming import NDJSON
+from flask import request, current_app, json, abort
+
+
+'''
+Bulk create
+
+	POST /api/posts/bulk  [{"title": ..., "body": ...}, ...]
+	POST /api/users/bulk  "Content-Type: application/x-ndjson", one object per line
+
+Items are checked in batch: one query per chunk of items finds every unique
+value that is already taken, duplicates inside the request are caught in
+Python. The remaining items go in with one executemany in a single
+transaction. Every item gets a result in request order:
+
+	{"index": 0, "status": "created", "id": 12}
+	{"index": 1, "status": "conflict", "field": "slug"}
+	{"index": 2, "status": "invalid", "field": "body"}
+'''
+
+
+def read_items():
+	'''Request body as a list of dicts, from a JSON array or NDJSON.'''
+	maximum = current_app.config.get('API_BULK_MAX_ITEMS', 10000)
+	if request.mimetype == NDJSON:
+		items = []
+		for line in request.stream:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				items.append(json.loads(line))
+			except ValueError:
+				abort(400)  # Bad NDJSON line
+			if len(items) > maximum:
+				abort(413)  # Too many items
+	else:
+		items = request.get_json(silent=True)
+		if not isinstance(items, list):
+			abort(400)  # Expected a JSON array
+		if len(items) > maximum:
+			abort(413)  # Too many items
+	return items
+
+
+def chunks(values, size):
+	for i in range(0, len(values), size):
+		yield values[i:i + size]
+
+
+def taken_values(model, rows, fields):
+	'''{field: set of values already in the table} for the unique fields of rows.'''
+	size = current_app.config.get('API_BULK_QUERY_CHUNK', 1000)
+	taken = {field: set() for field in fields}
+	columns = [getattr(model, field) for field in fields]
+	for chunk in chunks(rows, size):
+		filters = [column.in_([row[field] for row in chunk]) for field, column in zip(fields, columns)]
+		for found in db.session.query(*columns).filter(db.or_(*filters)):
+			for field, value in zip(fields, found):
+				taken[field].add(value)
+	return taken
+
+
+def check_items(model, items, required, unique, build):
+	'''
+	Split items into rows to insert and per-item results.
+
+	build(item) turns a valid item into a row dict holding every unique field.
+	'''
+	results = [None] * len(items)
+	candidates = []
+	for index, item in enumerate(items):
+		if not isinstance(item, dict):
+			results[index] = {'index': index, 'status': 'invalid', 'field': None}
+			continue
+		missing = [field for field in required if not isinstance(item.get(field), str)]
+		if missing:
+			results[index] = {'index': index, 'status': 'invalid', 'field': missing[0]}
+			continue
+		candidates.append((index, build(item)))
+
+	taken = taken_values(model, [row for index, row in candidates], unique)
+	rows = []
+	for index, row in candidates:
+		field = next((name for name in taken if row[name] in taken[name]), None)
+		if field is not None:
+			results[index] = {'index': index, 'status': 'conflict', 'field': field}
+			continue
+		# Later items in the same request conflict with earlier ones
+		for name in taken:
+			taken[name].add(row[name])
+		results[index] = {'index': index, 'status': 'created'}
+		rows.append((index, row))
+	return rows, results
+
+
+def insert_rows(model, rows, key):
+	'''executemany in the session transaction, {key value: new id} for rows.'''
+	if not rows:
+		return {}
+	db.session.execute(model.__table__.insert(), rows)
+	size = current_app.config.get('API_BULK_QUERY_CHUNK', 1000)
+	column = getattr(model, key)
+	ids = {}
+	for chunk in chunks([row[key] for row in rows], size):
+		ids.update(db.session.query(column, model.id).filter(column.in_(chunk)))
+	return ids
+
+
+def bulk_response(results):
+	counts = {'created': 0, 'conflict': 0, 'invalid': 0}
+	for result in results:
+		counts[result['status']] += 1
+	return {
+		'created': counts['created'],
+		'conflicts': counts['conflict'],
+		'invalid': counts['invalid'],
+		'items': results
+	}
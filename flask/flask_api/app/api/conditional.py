@@ -0,0 +1,44 @@
+from flask import request, Response
+
+
+'''
+Conditional GET
+
+The view computes an ETag and Last-Modified from a cheap query (a single
+column or an aggregate), calls not_modified() and returns its 304 before
+loading or serializing anything. Otherwise the full response goes out with
+with_validators() setting the same headers.
+
+Pass last_modified only when that timestamp moves with every change to the
+payload, If-Modified-Since is answered from it alone.
+'''
+
+
+def not_modified(etag, last_modified=None):
+	'''304 response when the client copy is current, None otherwise.'''
+	if request.if_none_match:
+		# If-None-Match wins over If-Modified-Since (RFC 7232 3.3)
+		if not request.if_none_match.contains(etag):
+			return None
+	elif last_modified is None or request.if_modified_since is None:
+		return None
+	elif last_modified.replace(microsecond=0) > request.if_modified_since:
+		return None
+
+	response = Response(status=304)
+	return with_validators(response, etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+	response.set_etag(etag)
+	if last_modified is not None:
+		response.last_modified = last_modified
+	# Clients may keep the copy but must check back before using it
+	response.cache_control.no_cache = True
+	return response
+
+
+def version_tag(*parts):
+	return '-'.join(
+		part.isoformat() if hasattr(part, 'isoformat') else str(part) for part in parts
+	)
@@ -0,0 +1,68 @@
+import json
+from .. import metrics
+from collections import OrderedDict
+from flask import request, current_app
+
+try:
+	import orjson
+except ImportError:  # Optional, stdlib json otherwise
+	orjson = None
+
+try:
+	import msgpack
+except ImportError:  # Optional, no MessagePack responses without it
+	msgpack = None
+
+
+'''
+Response encoders
+
+	GET /api/posts/                                 -> JSON (orjson when installed)
+	GET /api/posts/ "Accept: application/msgpack"   -> MessagePack
+
+Payloads hold plain types only, to_json formats datetimes itself (HTTP date,
+the format jsonify used), so every encoder writes the same values.
+'''
+
+MSGPACK = 'application/msgpack'
+
+
+def encode_json(data):
+	pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+	if orjson is not None:
+		return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+	if pretty:
+		return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+	return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def encode_compact(data):
+	# One line, no indent even when pretty printing, for NDJSON and stream chunks
+	if orjson is not None:
+		return orjson.dumps(data)
+	return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def encode_msgpack(data):
+	return msgpack.packb(data, use_bin_type=True)
+
+
+# Mimetype -> encoder, the first one is the default
+ENCODERS = OrderedDict([('application/json', encode_json)])
+if msgpack is not None:
+	ENCODERS[MSGPACK] = encode_msgpack
+	ENCODERS['application/x-msgpack'] = encode_msgpack
+
+
+def negotiate():
+	return request.accept_mimetypes.best_match(list(ENCODERS), default='application/json')
+
+
+def encode_response(data, status=200):
+	'''Response with data in the encoding the Accept header asks for.'''
+	mimetype = negotiate()
+	with metrics.phase('serialize'):
+		body = ENCODERS[mimetype](data)
+	response = current_app.response_class(body, status=status, mimetype=mimetype)
+	response.vary.add('Accept')
+	return response
@@ -1,3 +1,51 @@
 from . import api
-from flask import jsonify
+from .. import db
+from contextlib import contextmanager
+from flask import jsonify, abort
+from sqlalchemy.exc import IntegrityError
 
+
+def conflict(field, message=None):
+	response = jsonify({
+		'error': 'conflict',
+		'field': field,
+		'message': message or '%s already exists' % field
+	})
+	response.status_code = 409
+	return response
+
+
+def conflicting_field(error, model):
+	# Unique column named in the driver message:
+	# SQLite "UNIQUE constraint failed: users.email",
+	# MySQL "Duplicate entry 'x' for key 'ix_users_email'"
+	message = str(error.orig)
+	table = model.__tablename__
+	for column in model.__table__.columns:
+		if not column.unique:
+			continue
+		names = (
+			'%s.%s' % (table, column.name),
+			'ix_%s_%s' % (table, column.name),
+			"'%s'" % column.name
+		)
+		if any(name in message for name in names):
+			return column.name
+	return None
+
+
+# Writes rely on the unique indexes instead of checking first:
+#	with unique_conflicts(User):
+#		db.session.add(user)
+#		db.session.commit()
+# A violation rolls back and answers 409 with the conflicting field.
+@contextmanager
+def unique_conflicts(model):
+	try:
+		yield
+	except IntegrityError as e:
+		db.session.rollback()
+		field = conflicting_field(e, model)
+		if field is None:
+			raise
+		abort(conflict(field))
@@ -0,0 +1,79 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from .encoders import encode_response
+from flask import request, current_app, abort
+from sqlalchemy import and_, or_
+
+
+'''
+Keyset (cursor) pagination
+
+	GET /api/posts/?limit=20
+	GET /api/posts/?limit=20&after=<next>
+
+Pages are read with "WHERE key > last_key ORDER BY key LIMIT n" on indexed
+columns, so every page costs the same no matter how deep the client goes.
+The cursor is the key of the last row on the page, base64 encoded.
+'''
+
+
+def encode_cursor(values):
+	values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+	raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+	return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+	try:
+		raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		values = json.loads(raw.decode('utf-8'))
+		if not isinstance(values, list) or len(values) != len(columns):
+			raise ValueError(cursor)
+		return [
+			datetime.fromisoformat(value) if column.type.python_type is datetime else value
+			for column, value in zip(columns, values)
+		]
+	except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+		abort(400)  # Bad cursor
+
+
+def page_limit():
+	default = current_app.config.get('API_PAGE_SIZE', 50)
+	maximum = current_app.config.get('API_MAX_PAGE_SIZE', 500)
+	limit = request.args.get('limit', default, type=int)
+	return max(1, min(limit, maximum))
+
+
+def _after(columns, values, descending):
+	# (a, b) > (x, y) written out, so it works on every backend and uses the index
+	clauses = []
+	for i, column in enumerate(columns):
+		equal = [columns[j] == values[j] for j in range(i)]
+		step = column < values[i] if descending else column > values[i]
+		clauses.append(and_(*(equal + [step])))
+	return or_(*clauses)
+
+
+def paginate(query, *columns, descending=False):
+	'''Return (rows, next_cursor) for the page requested in the query string.'''
+	limit = page_limit()
+	after = request.args.get('after')
+	if after:
+		query = query.filter(_after(columns, decode_cursor(after, columns), descending))
+	order = [column.desc() if descending else column.asc() for column in columns]
+	rows = query.order_by(*order).limit(limit + 1).all()
+
+	next_cursor = None
+	if len(rows) > limit:
+		rows = rows[:limit]
+		next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in columns])
+	return rows, next_cursor
+
+
+def page_response(items, next_cursor):
+	return encode_response({
+		'items': items,
+		'next': next_cursor
+	})
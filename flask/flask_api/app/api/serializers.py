@@ -0,0 +1,177 @@
+from collections import defaultdict
+from .. import db, metrics
+from ..models import User, Post, Category, category_tree_table
+from flask import request, has_request_context, abort
+
+
+'''
+Batch serialization
+
+to_json on a single object lazy loads its relationships row by row, so a list
+of n users costs 1 + n (posts) + posts (authors) queries. The dump_* functions
+build the same output for a whole result set in a fixed number of queries:
+list queries take their eager loads from the *_options() plan, and the dynamic
+relationships are fetched with one IN query per relationship.
+
+Sparse fieldsets: ?fields=title,slug,author limits the output to those fields
+and the queries to the columns behind them (load_only), so a large column
+like Post.body is not read at all unless it is asked for.
+'''
+
+# Output field -> columns it is built from
+USER_FIELDS = {
+	'username': ('username',),
+	'email': ('email',),
+	'role': ('role_id',),
+	'posts': (),
+	'categories': ()
+}
+POST_FIELDS = {
+	'title': ('title',),
+	'slug': ('slug',),
+	'body': ('body',),
+	'timestamp': ('timestamp',),
+	'image': ('image',),
+	'images': ('image', 'image_variants'),
+	'author': ('author_id',),
+	'date_modified': ('date_modified',),
+	'moderator': ('moderator',),
+	'summary': ('summary',),
+	'word_count': ('word_count',)
+}
+# Listings leave out the body unless it is asked for
+POST_LISTING_FIELDS = Post.LISTING_FIELDS
+CATEGORY_FIELDS = {
+	'priority': ('priority',),
+	'display_name': ('display_name',),
+	'custom_template': ('custom_template',),
+	'custom_template_url': ('custom_template_url',),
+	'children': (),
+	'parents': ()
+}
+
+
+def requested_fields(known, default=None):
+	'''Fields listed in ?fields=, default (None for all of them) without it.'''
+	value = request.args.get('fields') if has_request_context() else None
+	if not value:
+		return default
+	fields = [field.strip() for field in value.split(',') if field.strip()]
+	if not fields or any(field not in known for field in fields):
+		abort(400)  # Unknown field
+	return fields
+
+
+def _load_only(known, fields, *always):
+	columns = set(always)
+	for field in fields:
+		columns.update(known[field])
+	return db.load_only(*sorted(columns))
+
+
+# Eager load plans, apply to the list query: Model.query.options(*user_options())
+def user_options():
+	fields = requested_fields(USER_FIELDS)
+	if fields is None:
+		return [db.joinedload(User.role)]
+	options = [_load_only(USER_FIELDS, fields, 'id')]
+	if 'role' in fields:
+		options.append(db.joinedload(User.role))
+	return options
+
+
+def post_options(default=None):
+	fields = requested_fields(POST_FIELDS, default)
+	if fields is None:
+		return [db.undefer(Post.body), db.joinedload(Post.author)]
+	# timestamp is part of the list_posts page cursor, author_id tags cached posts
+	options = [_load_only(POST_FIELDS, fields, 'id', 'timestamp', 'author_id')]
+	if 'author' in fields:
+		options.append(db.joinedload(Post.author).load_only('username'))
+	return options
+
+
+def category_options():
+	fields = requested_fields(CATEGORY_FIELDS)
+	if fields is None:
+		return []
+	return [_load_only(CATEGORY_FIELDS, fields, 'id')]
+
+
+def _prefetch_authors(posts):
+	# Loaded users sit in the identity map, so post.author then needs no query
+	missing = {
+		post.author_id for post in posts
+		if post.author_id is not None and 'author' not in post.__dict__
+	}
+	if missing:
+		User.query.filter(User.id.in_(missing)).all()
+
+
+@metrics.timed('serialize')
+def dump_posts(posts, default=None):
+	fields = requested_fields(POST_FIELDS, default)
+	if fields is None or 'author' in fields:
+		_prefetch_authors(posts)
+	return [post.to_json(fields) for post in posts]
+
+
+@metrics.timed('serialize')
+def dump_users(users):
+	fields = requested_fields(USER_FIELDS)
+	posts_by_author = defaultdict(list)
+	ids = [user.id for user in users]
+	if ids and (fields is None or 'posts' in fields):
+		posts = Post.query.options(_load_only(POST_FIELDS, POST_LISTING_FIELDS, 'id')).filter(
+			Post.author_id.in_(ids)
+		).order_by(Post.id).all()
+		for post in posts:
+			posts_by_author[post.author_id].append(post)
+	return [user.to_json(posts=posts_by_author[user.id], fields=fields) for user in users]
+
+
+@metrics.timed('serialize')
+def dump_categories(categories):
+	fields = requested_fields(CATEGORY_FIELDS)
+	children = defaultdict(list)
+	parents = defaultdict(list)
+	ids = [category.id for category in categories]
+	if ids and (fields is None or 'children' in fields or 'parents' in fields):
+		parent = db.aliased(Category)
+		child = db.aliased(Category)
+		edges = db.session.query(
+			category_tree_table.c.parent_id,
+			category_tree_table.c.children_id,
+			parent.display_name,
+			child.display_name
+		).join(
+			parent, parent.id == category_tree_table.c.parent_id
+		).join(
+			child, child.id == category_tree_table.c.children_id
+		).filter(db.or_(
+			category_tree_table.c.parent_id.in_(ids),
+			category_tree_table.c.children_id.in_(ids)
+		)).all()
+		for parent_id, child_id, parent_name, child_name in edges:
+			children[parent_id].append(child_name)
+			parents[child_id].append(parent_name)
+	return [
+		category.to_json(children=children[category.id], parents=parents[category.id], fields=fields)
+		for category in categories
+	]
+
+
+def dump_user(user):
+	return dump_users([user])[0]
+
+
+def dump_post_listing(posts):
+	return dump_posts(posts, POST_LISTING_FIELDS)
+
+
+def dump_post(post):
+	return dump_posts([post])[0]
+
+
+def dump_category(category):
+	return dump_categories([category])[0]
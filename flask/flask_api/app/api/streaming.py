@@ -0,0 +1,69 @@
+from .encoders import ENCODERS, encode_compact, encode_msgpack, negotiate
+from flask import Response, request, current_app, stream_with_context
+
+
+'''
+Streaming export
+
+	GET /api/users/?stream=1                          -> one JSON array
+	GET /api/users/ "Accept: application/x-ndjson"    -> one JSON object per line
+	GET /api/users/?stream=1 "Accept: application/msgpack"
+	                                                  -> MessagePack objects back to back,
+	                                                     read with msgpack.Unpacker
+
+Rows are read with a server-side cursor (yield_per) and written as they are
+serialized, so the first byte goes out right away and memory holds one batch
+instead of the whole table.
+'''
+
+NDJSON = 'application/x-ndjson'
+
+
+def wants_ndjson():
+	return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def stream_mimetype():
+	# NDJSON, else whatever encode_response would pick
+	return NDJSON if wants_ndjson() else negotiate()
+
+
+def wants_stream():
+	return wants_ndjson() or request.args.get('stream', '') in ('1', 'true')
+
+
+def stream_query(query, dump_many, batch_size=None):
+	'''Stream every row of query, serialized batch by batch with dump_many.'''
+	if batch_size is None:
+		batch_size = current_app.config.get('API_STREAM_BATCH_SIZE', 500)
+	mimetype = stream_mimetype()
+	msgpack = ENCODERS.get(mimetype) is encode_msgpack
+	array = not (mimetype == NDJSON or msgpack)
+
+	def encode(items, first):
+		if mimetype == NDJSON:
+			return b''.join(encode_compact(item) + b'\n' for item in items)
+		if msgpack:
+			return b''.join(encode_msgpack(item) for item in items)
+		chunk = b','.join(encode_compact(item) for item in items)
+		return chunk if first else b',' + chunk
+
+	def generate():
+		if array:
+			yield b'['
+		first = True
+		batch = []
+		for row in query.yield_per(batch_size):
+			batch.append(row)
+			if len(batch) >= batch_size:
+				yield encode(dump_many(batch), first)
+				first = False
+				batch = []
+		if batch:
+			yield encode(dump_many(batch), first)
+		if array:
+			yield b']'
+
+	response = Response(stream_with_context(generate()), mimetype=mimetype)
+	response.vary.add('Accept')
+	return response
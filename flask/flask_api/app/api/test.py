@@ -1,10 +1,24 @@
 from . import api
-from .. import db
-from ..models import User, Role, Category, Post, Permission, Tag
-from flask import jsonify, request, current_app, url_for, abort, g
-from flask_httpauth import HTTPBasicAuth
+from .. import db, credential_cache, response_cache, metrics, search_index, availability, image_store
+from ..models import User, Role, Category, Post, Permission, Tag, role_cache, \
+	category_tree, category_tree_table, category_closure_table, token_versions
+from .pagination import paginate, page_response, page_limit
+from .streaming import wants_stream, stream_query
+from .conditional import not_modified, with_validators, version_tag
+from .errors import unique_conflicts
+from .bulk import read_items, check_items, insert_rows, bulk_response
+from .encoders import encode_response
+from .serializers import dump_user, dump_users, dump_post, dump_post_listing, \
+	dump_category, dump_categories, user_options, post_options, category_options, POST_LISTING_FIELDS
+from flask import request, current_app, url_for, abort, g, Response, send_from_directory
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from slugify import slugify
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.formparser import FormDataParser
+from werkzeug.security import generate_password_hash
+import hashlib
+import io
 
 
 '''
@@ -18,14 +32,34 @@ Examples
 	DELETE	|	Delete a resource					|	http://example.com/api/orders/123 (delete order #123)
 '''
 
-auth = HTTPBasicAuth()
+# "Authorization: Basic ..." (email and password) or "Authorization: Bearer <token>"
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+auth = MultiAuth(basic_auth, token_auth)
 
 
 # Role check for HTTPAuth
-@auth.get_user_roles
+@basic_auth.get_user_roles
 def get_user_roles(user):
-	user = User.query.filter_by(email=user.username).first()
-	return user.get_role()
+	# g.user is loaded by verify_password, role names come from the role cache
+	user = g.get('user')
+	if user is None:
+		return None
+	return role_cache.name(user.role_id)
+
+
+# Role check for tokens, the role is signed into the token
+@token_auth.get_user_roles
+def get_token_roles(identity):
+	return identity['role']
+
+
+def request_user():
+	# Basic auth loads the user, token auth only knows the id until it's needed
+	user = g.get('user')
+	if user is None and g.get('user_id') is not None:
+		user = g.user = User.load_identity(user_id=g.user_id)
+	return user
 
 
 # User START ---------------------------------------------------------------
@@ -39,47 +73,95 @@ def register():
 	email = request.json.get('email')
 	if (username is None) or (password is None) or (email is None):
 		abort(400)  # Missing argument
-	if User.query.filter_by(username=username).first() is not None:
-		abort(400)  # User already exist
-	if User.query.filter_by(email=email).first() is not None:
-		abort(400)  # Email already exist
 	user = User(
 		username=username,
 		email=email
 	)
 	user.password = password
-	db.session.add(user)
-	db.session.commit()
-	return jsonify(user.to_json())
+	with unique_conflicts(User):  # 409 if username or email exist
+		db.session.add(user)
+		db.session.commit()
+	return encode_response(user.to_json())
+
+
+# _User - Availability
+# Sign-up forms check as the user types, a name never seen is answered without a query
+# HTTPIE: http localhost:5000/api/availability username==<input> email==<input>
+@api.route('/availability', methods=['GET'])
+def check_availability():
+	fields = [field for field in availability.FIELDS if request.args.get(field)]
+	if not fields:
+		abort(400)  # Missing argument
+	return encode_response({
+		field: not availability.is_taken(field, request.args[field]) for field in fields
+	})
 
 
 # _User - Load User
 # HTTPIE: http --json localhost:5000/api/ "email=<input>" "password=<input>"
 @api.route('/load_user/', methods=['GET', 'POST'])
+@db.read_replica
 def load_user():
 	username = request.json.get('username')
-	user = User.query.filter_by(username=username).first()
-	return jsonify(user.to_json())
+	user = User.query.options(*user_options()).filter_by(username=username).first()
+	if user is None:
+		abort(400)
+	return encode_response(dump_user(user))
 
 
 # _User - List usernames
-# HTTPIE: https --verify no --auth <email>:<password> --json localhost:5000/api/usernames/
+# HTTPIE: https --verify no --auth <email>:<password> --json localhost:5000/api/usernames/ limit==100
 @api.route('/usernames/', methods=['GET'])
 @auth.login_required()
+@db.read_replica
 def list_usernames():
-	username_list = [i.username for i in User.query.all()]
-	return jsonify(username_list)
+	rows, next_cursor = paginate(User.query.with_entities(User.id, User.username), User.id)
+	return page_response([row.username for row in rows], next_cursor)
 
 
 # _User - List users
-# Return a list of users and user info. Add pagination?
+# Return a page of users and user info, next page with after=<next>
+# Full export: stream=1 or "Accept: application/x-ndjson"
 @api.route('/users/', methods=['GET'])
 @auth.login_required(role='admin')
+@db.read_replica
 def list_users():
-	user_list = [
-		user.to_json() for user in User.query.all()
-	]
-	return jsonify(user_list)
+	if wants_stream():
+		return stream_query(User.query.options(*user_options()).order_by(User.id), dump_users)
+	users, next_cursor = paginate(User.query.options(*user_options()), User.id)
+	return page_response(dump_users(users), next_cursor)
+
+
+# _User - Bulk create
+# JSON array or NDJSON of {"username", "email", "password"}, results per item
+# HTTPIE: http --auth <email>:<password> --json localhost:5000/api/users/bulk < users.json
+@api.route('/users/bulk', methods=['POST'])
+@auth.login_required(role='admin')
+def bulk_users():
+	items = read_items()
+	role = Role.query.filter_by(default=True).first()
+
+	def build(item):
+		return {
+			'username': item['username'],
+			'email': item['email'],
+			'role_id': role.id if role is not None else None
+		}
+
+	rows, results = check_items(User, items, ('username', 'email', 'password'), ('username', 'email'), build)
+	# Hashing dominates, pbkdf2 releases the GIL so threads run it in parallel
+	passwords = [items[index]['password'] for index, row in rows]
+	with ThreadPoolExecutor(current_app.config.get('API_BULK_HASH_WORKERS', 4)) as pool:
+		for (index, row), password_hash in zip(rows, pool.map(generate_password_hash, passwords)):
+			row['password_hash'] = password_hash
+
+	with unique_conflicts(User):  # 409 if a concurrent write took a value
+		ids = insert_rows(User, [row for index, row in rows], 'username')
+		db.session.commit()
+	for index, row in rows:
+		results[index]['id'] = ids[row['username']]
+		availability.add(username=row['username'], email=row['email'])
+	return encode_response(bulk_response(results))
 
 
 # _User - Edit
@@ -87,7 +169,7 @@ def list_users():
 @api.route('/users/edit/', methods=['POST'])
 @auth.login_required()
 def edit_user():
-	user = g.user
+	user = request_user()
 	username = request.json.get('username')
 	password = request.json.get('password')
 	email = request.json.get('email')
@@ -98,20 +180,16 @@ def edit_user():
 	if (request.json.get('username') is None) or (request.json.get('email') is None):
 		abort(400)  # Missing argument
 
-	username_check = User.query.filter_by(username=username).first()
-	if (username_check is not None) and (username_check is not user):
-		abort(400)  # User already exist
-
-	email_check = User.query.filter_by(email=email).first()
-	if (email_check is not None) and (email_check is not user):
-		abort(400)  # Email already exist
-
 	user.username = username
 	user.email = email
 
-	db.session.add(user)
-	db.session.commit()
-	return jsonify(user.to_json())
+	with unique_conflicts(User):  # 409 if username or email exist
+		db.session.add(user)
+		db.session.commit()
+	credential_cache.invalidate(user.id)
+	token_versions.invalidate(user.id)
+	response_cache.invalidate('user:%s' % user.id)
+	return encode_response(user.to_json())
 
 
 # _User - Admin Edit
@@ -133,20 +211,16 @@ def edit_user_admin(user_id):
 	if (request.json.get('username') is None) or (request.json.get('email') is None):
 		abort(400)  # Missing argument
 
-	username_check = User.query.filter_by(username=username).first()
-	if (username_check is not None) and (username_check is not user):
-		abort(400)  # User already exist
-
-	email_check = User.query.filter_by(email=email).first()
-	if (email_check is not None) and (email_check is not user):
-		abort(400)  # Email already exist
-
 	user.username = username
 	user.email = email
 
-	db.session.add(user)
-	db.session.commit()
-	return jsonify(user.to_json())
+	with unique_conflicts(User):  # 409 if username or email exist
+		db.session.add(user)
+		db.session.commit()
+	credential_cache.invalidate(user.id)
+	token_versions.invalidate(user.id)
+	response_cache.invalidate('user:%s' % user.id)
+	return encode_response(user.to_json())
 
 
 # _User - Admin delete
@@ -154,15 +228,18 @@ def edit_user_admin(user_id):
 @auth.login_required(role='admin')
 def delete_user_admin(user_id):
 	user = User.query.filter_by(id=user_id).first()
-	print(user)
-	username = user.username
 
 	if user is None:
 		abort(400)
 
-	if user.role != "admin":
+	username = user.username
+
+	if user.get_role() != 'admin':
 		db.session.delete(user)
 		db.session.commit()
+		credential_cache.invalidate(user.id)
+		token_versions.invalidate(user.id)
+		response_cache.invalidate('user:%s' % user.id)
 	else:
 		abort(400)
 
@@ -177,7 +254,7 @@ def delete_user_admin(user_id):
 @api.route('/test', methods=['GET'])
 @auth.login_required()
 def get_resources():
-	return jsonify({'data': 'Hello, %s' % g.user.username})
+	return encode_response({'data': 'Hello, %s' % request_user().username})
 
 
 @api.route('/testapi/', methods=['GET'])
@@ -185,16 +262,132 @@ def test_api():
 	return {'result': "ERPA DERPA"}
 
 
-@auth.verify_password
+@basic_auth.verify_password
 def verify_password(email, password):
-	user = User.query.filter_by(email=email).first()
+	# Cached credentials skip the password hash, the user is still loaded by id.
+	# A password changed in another process leaves a different hash on the row.
+	cached = credential_cache.get(email, password)
+	if cached is not None:
+		user_id, password_hash = cached
+		user = User.load_identity(user_id=user_id)
+		if user is not None and user.email == email and user.password_hash == password_hash:
+			g.user = user
+			g.user_id = user.id
+			return True
+		credential_cache.invalidate(user_id)
+
+	user = User.load_identity(email=email)
 	if not user or not user.verify_password(password):
 		return False
+	credential_cache.add(email, password, user.id, user.password_hash)
 	g.user = user
+	g.user_id = user.id
 	return True
 
+
+@token_auth.verify_token
+def verify_token(token):
+	identity = User.verify_auth_token(token, current_app.config.get('API_TOKEN_TTL', 3600))
+	if identity is None:
+		return False
+	g.user_id = identity['id']
+	return identity
+
+
+# _Token - New
+# Exchange email and password for a signed token, then send "Authorization: Bearer <token>"
+# HTTPIE: http --auth <email>:<password> POST localhost:5000/api/tokens/
+@api.route('/tokens/', methods=['POST'])
+@basic_auth.login_required()
+def new_token():
+	return encode_response({
+		'token': g.user.generate_auth_token(),
+		'expires_in': current_app.config.get('API_TOKEN_TTL', 3600)
+	})
+
+
+# _Token - Revoke
+# Invalidates every token of the user, changing the password does the same
+@api.route('/tokens/revoke/', methods=['POST'])
+@auth.login_required()
+def revoke_tokens():
+	user = request_user()
+	user.revoke_tokens()
+	db.session.commit()
+	token_versions.invalidate(user.id)
+	return {'result': 'Tokens for %s, been revoked' % user.username}
+
+
+# _Token - Admin revoke
+@api.route('/tokens/revoke/<user_id>/', methods=['POST'])
+@auth.login_required(role='admin')
+def revoke_tokens_admin(user_id):
+	user = User.query.filter_by(id=user_id).first()
+	if user is None:
+		abort(400)
+	user.revoke_tokens()
+	db.session.commit()
+	token_versions.invalidate(user.id)
+	return {'result': 'Tokens for %s, been revoked' % user.username}
+
+
+# Credential cache hit/miss counters
+# HTTPIE: http --auth <email>:<password> --json localhost:5000/api/cache/credentials/
+@api.route('/cache/credentials/', methods=['GET'])
+@auth.login_required(role='admin')
+def credential_cache_stats():
+	return encode_response(credential_cache.stats())
+
+
+# Response cache hit ratio
+@api.route('/cache/responses/', methods=['GET'])
+@auth.login_required(role='admin')
+def response_cache_stats():
+	return encode_response(response_cache.stats())
+
 # TEST - END ---------------------------------------------------------------
 
+# METRICS START ---------------------------------------------------------------
+
+# _Metrics - Prometheus text format
+# HTTPIE: http localhost:5000/api/_metrics
+@api.route('/_metrics', methods=['GET'])
+def metrics_view():
+	return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def credential_cache_samples():
+	stats = credential_cache.stats()
+	return [
+		('api_credential_cache_hits_total', 'counter', 'Credential cache hits.', stats['hits']),
+		('api_credential_cache_misses_total', 'counter', 'Credential cache misses.', stats['misses']),
+		('api_credential_cache_size', 'gauge', 'Cached credentials.', stats['size'])
+	]
+
+
+def response_cache_samples():
+	stats = response_cache.stats()
+	return [
+		('api_response_cache_hits_total', 'counter', 'Response cache hits.', stats['hits']),
+		('api_response_cache_misses_total', 'counter', 'Response cache misses.', stats['misses']),
+		('api_response_cache_hit_ratio', 'gauge', 'Response cache hits / lookups.', stats['hit_ratio'])
+	]
+
+
+def availability_samples():
+	stats = availability.stats()
+	return [
+		('api_availability_negatives_total', 'counter', 'Availability checks answered by the filter.', stats['negatives']),
+		('api_availability_lookups_total', 'counter', 'Availability checks that queried the database.', stats['lookups'])
+	]
+
+
+metrics.add_collector(credential_cache_samples)
+metrics.add_collector(response_cache_samples)
+metrics.add_collector(availability_samples)
+
+# METRICS END ---------------------------------------------------------------
+
 # ROLES START ---------------------------------------------------------------
 
 # _Roles - Get role
@@ -203,11 +396,10 @@ def verify_password(email, password):
 # _Roles - List of roles
 @api.route('/roles/', methods=['GET'])
 @auth.login_required(role='admin')
+@db.read_replica
 def list_roles():
-	role_list = [
-		role.to_json() for role in Role.query.all()
-	]
-	return jsonify(role_list)
+	roles, next_cursor = paginate(Role.query, Role.id)
+	return page_response([role.to_json() for role in roles], next_cursor)
 
 
 # _Roles - Edit Role
@@ -224,15 +416,13 @@ def role_edit(role_id):
 	if name is None:
 		abort(400)
 
-	name_check = Role.query.filter_by(name=name).first()
-	if (name_check is not None) and (name_check is not name):
-		abort(400)  # Name already used.
-
 	role.name = name
-	db.session.add(role)
-	db.session.commit()
+	with unique_conflicts(Role):  # 409 if name is used
+		db.session.add(role)
+		db.session.commit()
+	role_cache.invalidate()
 
-	return jsonify(role.to_json())
+	return encode_response(role.to_json())
 
 
 # _Roles - Delete Role
@@ -244,12 +434,13 @@ def role_delete(role_id):
 	if role is None:
 		abort(400)
 
-	if role.name is 'admin':
+	if role.name == 'admin':
 		abort(400)
 
 	name = role.name
 	db.session.delete(role)
 	db.session.commit()
+	role_cache.invalidate()
 
 	return {'result': 'Role %s, been deleted' % name}
 
@@ -261,14 +452,14 @@ def role_add():
 	name = request.json.get('name')
 	if name is None:
 		abort(400)  # Missing argument
-	if Role.query.filter_by(name=name).first() is not None:
-		abort(400)  # User already exist
 	role = Role(
 		name=name
 	)
-	db.session.add(role)
-	db.session.commit()
-	return jsonify(role.to_json())
+	with unique_conflicts(Role):  # 409 if name is used
+		db.session.add(role)
+		db.session.commit()
+	role_cache.invalidate()
+	return encode_response(role.to_json())
 
 # ROLES END ---------------------------------------------------------------
 
@@ -276,21 +467,80 @@ def role_add():
 # POST START ---------------------------------------------------------------
 
 # _Post - Get post
+# ETag from date_modified and the author's username, which is part of the
+# payload but not of the post row. 304 without loading the post.
+# No Last-Modified, a renamed author doesn't move date_modified.
 @api.route('/posts/<post_id>', methods=['GET'])
+@response_cache.cached('post:{post_id}')
+@db.read_replica
 def get_post(post_id):
-	post = Post.query.filter_by(id=post_id).first()
-	if post is None:
+	version = db.session.query(Post.id, Post.date_modified, User.username).outerjoin(
+		User, User.id == Post.author_id
+	).filter(Post.id == post_id).first()
+	if version is None:
 		abort(400)
-	return jsonify(post.to_json())
+	author = hashlib.sha1((version.username or '').encode('utf-8')).hexdigest()[:12]
+	etag = version_tag('post', version.id, version.date_modified, author)
+	cached = not_modified(etag)
+	if cached is not None:
+		return cached
+
+	post = Post.query.options(*post_options()).filter_by(id=post_id).first()
+	response_cache.tag('user:%s' % post.author_id)
+	return with_validators(encode_response(dump_post(post)), etag)
 
 # _Post - List
+# Newest first, next page with after=<next>
+# Summaries without the body, add it with fields=title,body,...
+# Full export: stream=1 or "Accept: application/x-ndjson"
 @api.route('/posts/', methods=['GET'])
 @auth.login_required(role='admin')
+@db.read_replica
 def list_posts():
-	post_list = [
-		post.to_json() for post in Post.query.all()
+	if wants_stream():
+		return stream_query(
+			Post.query.options(*post_options(POST_LISTING_FIELDS)).order_by(Post.timestamp.desc(), Post.id.desc()),
+			dump_post_listing
+		)
+	posts, next_cursor = paginate(
+		Post.query.options(*post_options(POST_LISTING_FIELDS)), Post.timestamp, Post.id, descending=True
+	)
+	return page_response(dump_post_listing(posts), next_cursor)
+
+
+# _Post - Search
+# Ranked full text search over title and body, next page with offset=<next>
+# HTTPIE: http localhost:5000/api/posts/search q=="lorem ipsum"
+@api.route('/posts/search', methods=['GET'])
+def search_posts():
+	query = request.args.get('q', '')
+	limit = page_limit()
+	offset = max(0, request.args.get('offset', 0, type=int))
+	hits = search_index.search(query, limit + 1, offset)
+
+	next_offset = None
+	if len(hits) > limit:
+		hits = hits[:limit]
+		next_offset = offset + limit
+
+	posts = {
+		post.id: post for post in Post.query.options(
+			db.load_only('title', 'slug', 'author_id'), db.joinedload(Post.author).load_only('username')
+		).filter(
+			Post.id.in_([post_id for post_id, snippet in hits])
+		)
+	} if hits else {}
+	results = [
+		{
+			'id': post_id,
+			'title': posts[post_id].title,
+			'slug': posts[post_id].slug,
+			'author': posts[post_id].author.username if posts[post_id].author is not None else '',
+			'snippet': snippet
+		}
+		for post_id, snippet in hits if post_id in posts
 	]
-	return jsonify(post_list)
+	return page_response(results, next_offset)
 
 
 # _Post - New
@@ -301,23 +551,53 @@ def list_posts():
 def new_post():
 	title = request.json.get('title')
 	body = request.json.get('body')
-	slug = slugify(title)
-	author = User.query.filter_by(email=auth.current_user()).first()
 	if (title is None) or (body is None):
 		abort(400)  # Missing argument
-	if Post.query.filter_by(title=title).first() is not None:
-		abort(400)  # Title already exist
-	if Post.query.filter_by(slug=slug).first() is not None:
-		abort(400)  # Slug already exist
 	post = Post(
 		title=title,
 		body=body,
-		author=author,
-		slug=slug
+		author=request_user(),
+		slug=slugify(title)
 	)
-	db.session.add(post)
-	db.session.commit()
-	return jsonify(post.to_json())
+	with unique_conflicts(Post):  # 409 if title or slug exist
+		db.session.add(post)
+		db.session.flush()
+		search_index.index(post)
+		db.session.commit()
+	return encode_response(post.to_json())
+
+
+# _Post - Bulk create
+# JSON array or NDJSON of {"title", "body"}, results per item
+# HTTPIE: http --auth <email>:<password> --json localhost:5000/api/posts/bulk < posts.json
+@api.route('/posts/bulk', methods=['POST'])
+@auth.login_required(role='admin')
+def bulk_posts():
+	items = read_items()
+	now = datetime.utcnow()
+	author_id = request_user().id
+
+	def build(item):
+		summary, word_count = Post.summarize(item['body'])
+		return {
+			'title': item['title'],
+			'slug': slugify(item['title']),
+			'body': item['body'],
+			'summary': summary,
+			'word_count': word_count,
+			'timestamp': now,
+			'date_modified': now,
+			'author_id': author_id
+		}
+
+	rows, results = check_items(Post, items, ('title', 'body'), ('title', 'slug'), build)
+	with unique_conflicts(Post):  # 409 if a concurrent write took a value
+		ids = insert_rows(Post, [row for index, row in rows], 'slug')
+		for index, row in rows:
+			row['id'] = results[index]['id'] = ids[row['slug']]
+		search_index.index_many([row for index, row in rows])
+		db.session.commit()
+	return encode_response(bulk_response(results))
 
 
 # _Post - Moderate
@@ -330,28 +610,90 @@ def edit_post(slug):
 
 	title = request.json.get('title')
 	body = request.json.get('body')
-	slug = slugify(title)
-	date_modified = datetime.utcnow
-	moderator = User.query.filter_by(email=auth.current_user()).first()
-	image = ''
-
 	if (title is None) or (body is None):
 		abort(400)  # Missing argument
-	if Post.query.filter_by(title=title).first() is not None:
-		abort(400)  # Title already exist
-	if Post.query.filter_by(slug=slug).first() is not None:
-		abort(400)  # Slug already exist
+
+	slug = slugify(title)
+	date_modified = datetime.utcnow()
+	moderator = request_user().username
 
 	post.title = title
 	post.body = body
 	post.moderator = moderator
 	post.slug = slug
 	post.date_modified = date_modified
-	post.image = image
 
-	db.session.add(post)
+	with unique_conflicts(Post):  # 409 if title or slug exist
+		db.session.add(post)
+		search_index.index(post)
+		db.session.commit()
+	response_cache.invalidate('post:%s' % post.id)
+	return encode_response(post.to_json())
+
+
+# Request body of at most limit bytes, 413 past it. Read in chunks from the
+# stream, a chunked upload has no Content-Length to check up front.
+def read_body(limit):
+	if request.content_length is not None and request.content_length > limit:
+		abort(413)  # Too large
+	chunks = []
+	size = 0
+	while True:
+		chunk = request.stream.read(64 * 1024)
+		if not chunk:
+			break
+		size += len(chunk)
+		if size > limit:
+			abort(413)  # Too large
+		chunks.append(chunk)
+	return b''.join(chunks)
+
+
+# _Post - Image upload
+# Multipart field "image" or the raw file as body. The original is stored at
+# once, resized variants appear in "images" when the workers are done.
+# HTTPIE: http --auth <email>:<password> -f POST localhost:5000/api/posts/<post_id>/image image@photo.jpg
+@api.route('/posts/<post_id>/image', methods=['POST'])
+@auth.login_required(role='admin')
+def upload_post_image(post_id):
+	post = Post.query.filter_by(id=post_id).first()
+	if post is None:
+		abort(400)
+
+	body = read_body(current_app.config.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+	if request.mimetype == 'multipart/form-data':
+		stream, form, files = FormDataParser().parse(
+			io.BytesIO(body), request.mimetype, len(body), request.mimetype_params
+		)
+		upload = files.get('image')
+		data = upload.read() if upload is not None else None
+	else:
+		data = body
+	if not data:
+		abort(400)  # Missing image
+	try:
+		path = image_store.save(data)
+	except ValueError:
+		abort(400)  # Not a supported image
+
+	post.image = path
+	post.image_variants = None
+	post.date_modified = datetime.utcnow()
 	db.session.commit()
-	return jsonify(post.to_json())
+	response_cache.invalidate('post:%s' % post.id)
+	image_store.render(current_app._get_current_object(), post.id, path)
+	return encode_response(post.to_json(), status=202)
+
+
+# _Post - Images
+# Originals and variants by path, cached by clients for a year
+@api.route('/images/<path:filename>', methods=['GET'])
+def image_file(filename):
+	response = send_from_directory(image_store.root, filename)
+	response.cache_control.public = True
+	response.cache_control.max_age = current_app.config.get('IMAGE_CACHE_SECONDS', 365 * 24 * 3600)
+	response.cache_control.immutable = True
+	return response
 
 
 # _Post - Delete
@@ -363,8 +705,10 @@ def delete_post(post_id):
 		abort(400)
 
 	title = post.title
+	search_index.remove(post.id)
 	db.session.delete(post)
 	db.session.commit()
+	response_cache.invalidate('post:%s' % post_id)
 
 	return {'result': 'Post %s, been deleted' % title}
 
@@ -375,51 +719,173 @@ def delete_post(post_id):
 
 # Category START ---------------------------------------------------------------
 
+# Category ETags share one table version, a rename shows up in other categories' parents/children.
+# ETag only, a delete changes the count but not max(date_modified), so
+# Last-Modified/If-Modified-Since would miss it.
+def category_etag():
+	count, last_modified = Category.version()
+	return version_tag('categories', count, last_modified)
+
+
 # _Category - Get category
 @api.route('/categories/<category_id>')
+@response_cache.cached('categories')
+@db.read_replica
 def get_category(category_id):
-	category = Category.query.filter_by(id=category_id).first()
+	etag = category_etag()
+	cached = not_modified(etag)
+	if cached is not None:
+		return cached
+
+	category = Category.query.options(*category_options()).filter_by(id=category_id).first()
 
 	if category is None:
 		abort(400)
 
-	return jsonify(category.to_json())
+	return with_validators(encode_response(dump_category(category)), etag)
 
 
 # _Category - List
 @api.route('/categories/', methods=['GET'])
+@response_cache.cached('categories')
+@db.read_replica
 def list_categories():
-	category_list = [
-		category.to_json() for category in Category.query.all()
-	]
-	return jsonify(category_list)
+	etag = category_etag()
+	cached = not_modified(etag)
+	if cached is not None:
+		return cached
+
+	categories, next_cursor = paginate(Category.query.options(*category_options()), Category.id)
+	return with_validators(page_response(dump_categories(categories), next_cursor), etag)
+
+
+# _Category - Tree
+# Whole hierarchy sorted by priority, served from the category_tree cache
+# rebuilt when the category table version changes
+# HTTPIE: http --json localhost:5000/api/categories/tree
+@api.route('/categories/tree', methods=['GET'])
+@response_cache.cached('categories')
+@db.read_replica
+def category_tree_view():
+	etag = category_etag()
+	cached = not_modified(etag)
+	if cached is not None:
+		return cached
+	# Keyed on the table version, so writes from other processes rebuild it too
+	return with_validators(encode_response(category_tree.get(etag)), etag)
+
+
+# Replace parent/child links of a category, lists of category ids
+def set_category_links(category, parents, children):
+	ids = set(parents or []) | set(children or [])
+	if category.id in ids:
+		abort(400)  # Category can't be its own parent/child
+	if ids and Category.query.filter(Category.id.in_(ids)).count() != len(ids):
+		abort(400)  # Unknown category id
+	table = category_tree_table
+	if parents is not None:
+		db.session.execute(table.delete().where(table.c.children_id == category.id))
+		if parents:
+			db.session.execute(table.insert(), [
+				{'parent_id': parent_id, 'children_id': category.id} for parent_id in set(parents)
+			])
+	if children is not None:
+		db.session.execute(table.delete().where(table.c.parent_id == category.id))
+		if children:
+			db.session.execute(table.insert(), [
+				{'parent_id': category.id, 'children_id': child_id} for child_id in set(children)
+			])
+
+	# The tree had no cycle before, a new one has to run through this category.
+	# Checked on the written links, parents and children may close it together.
+	if (parents or children) and Category.in_cycle(category.id):
+		db.session.rollback()
+		abort(400)  # Parent is below this category or child above it
 
 
 # _Category - Edit
+# HTTPIE: http --auth <email>:<password> --json localhost:5000/api/categories/edit/<id> "priority:=10" "parents:=[1]"
 @api.route('/categories/edit/<category_id>', methods=['POST'])
+@auth.login_required(role='admin')
 def edit_category(category_id):
+	category = Category.query.filter_by(id=category_id).first()
+
+	if category is None:
+		abort(400)
+
 	priority = request.json.get('priority')
 	display_name = request.json.get('display_name')
 	custom_template = request.json.get('custom_template')
 	custom_url = request.json.get('custom_url')
-	# children = [] - LIST MORE WORK
-	# parents = [] - LIST MORE WORK
 
-	category = Category.query_filter_by(id=category_id).first()
+	if display_name is not None:
+		category.display_name = display_name
+	if priority is not None:
+		category.priority = priority
+	if custom_template is not None:
+		category.custom_template = custom_template
+	if custom_url is not None:
+		category.custom_template_url = custom_url
+	category.date_modified = datetime.utcnow()
+
+	with unique_conflicts(Category):  # 409 if display_name is used
+		db.session.add(category)
+		db.session.flush()
+		set_category_links(category, request.json.get('parents'), request.json.get('children'))
+		db.session.commit()
+	Category.changed()
+	response_cache.invalidate('categories')
 
-	return 'Category: Edit Category'
+	return encode_response(dump_category(category))
 
 
 # _Category - Delete
 @api.route('/categories/delete/<category_id>', methods=['POST'])
+@auth.login_required(role='admin')
 def delete_category(category_id):
-	return 'Category: Delete Category'
+	category = Category.query.filter_by(id=category_id).first()
+
+	if category is None:
+		abort(400)
+
+	display_name = category.display_name
+	set_category_links(category, [], [])
+	closure = category_closure_table
+	db.session.execute(closure.delete().where(
+		(closure.c.ancestor_id == category.id) | (closure.c.descendant_id == category.id)
+	))
+	db.session.delete(category)
+	db.session.commit()
+	Category.changed()
+	response_cache.invalidate('categories')
+
+	return {'result': 'Category %s, been deleted' % display_name}
 
 
 # _Category - Add
+# HTTPIE: http --auth <email>:<password> --json localhost:5000/api/categories/add "display_name=news" "parents:=[1]"
 @api.route('/categories/add', methods=['POST'])
-def add_category(category_id):
-	return 'Category: Add Category.'
+@auth.login_required(role='admin')
+def add_category():
+	display_name = request.json.get('display_name')
+	if display_name is None:
+		abort(400)  # Missing argument
+
+	category = Category(
+		display_name=display_name,
+		priority=request.json.get('priority', 100),
+		custom_template=request.json.get('custom_template', False),
+		custom_template_url=request.json.get('custom_url', '')
+	)
+	with unique_conflicts(Category):  # 409 if display_name is used
+		db.session.add(category)
+		db.session.flush()
+		set_category_links(category, request.json.get('parents'), request.json.get('children'))
+		db.session.commit()
+	Category.changed()
+	response_cache.invalidate('categories')
+
+	return encode_response(dump_category(category))
 
 # Category END ---------------------------------------------------------------
 
@@ -26,6 +26,8 @@ class RegisterForm(FlaskForm):
 	password2 = PasswordField('Confirm password: ', validators=[DataRequired()])
 	submit = SubmitField('Register')
 
+	# Indexed queries, the availability Bloom filter can be stale in this
+	# process and would let a taken name through to the insert
 	def validate_email(self, field):
 		if User.query.filter_by(email=field.data).first():
 			raise ValidationError('Email already taken.')
@@ -2,8 +2,10 @@ from . import auth
 from .forms import LoginForm, RegisterForm
 from ..models import User
 from .. import db
+from ..api.errors import conflicting_field
 from flask import redirect, url_for, render_template
 from flask_login import login_user, logout_user, current_user
+from sqlalchemy.exc import IntegrityError
 
 
 @auth.route('/')
@@ -21,7 +23,16 @@ def register():
 			password=form.password.data
 		)
 		db.session.add(user)
-		db.session.commit()
+		try:
+			db.session.commit()
+		except IntegrityError as e:
+			# Taken between the form check and the insert
+			db.session.rollback()
+			field = conflicting_field(e, User)
+			if field is None:
+				raise
+			getattr(form, field).errors.append('%s already taken.' % field.capitalize())
+			return render_template('auth/register.html', form=form)
 		return redirect(url_for('main.index'))
 	return render_template('auth/register.html', form=form)
 
@@ -0,0 +1,116 @@
+import hashlib
+import math
+import threading
+import time
+
+
+# Bloom filter
+# Set membership in a fixed bit array. "Not in" is always right, "in" may be
+# a false positive with probability error_rate while count <= capacity.
+# Values can't be removed, a deleted value just stays a false positive.
+class BloomFilter:
+	def __init__(self, capacity, error_rate=0.01):
+		self.capacity = capacity
+		self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+		self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def _positions(self, value):
+		# Double hashing, k positions from one 128 bit digest
+		digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def add(self, value):
+		for position in self._positions(value):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, value):
+		return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+# Username/email availability
+# One Bloom filter per unique User field, built from the users table on first
+# use. A value the filter has never seen is free without a query, anything
+# else is checked with one indexed query. Writes in this process add their
+# values right away (see models.py), users written by other processes are
+# picked up every refresh seconds by a full rebuild.
+class Availability:
+	FIELDS = ('username', 'email')
+
+	def __init__(self, db=None, app=None):
+		self.db = db
+		self.capacity = 100000
+		self.error_rate = 0.01
+		self.refresh = 300
+		self._filters = None
+		self._built = 0.0
+		self._lock = threading.Lock()
+		self.negatives = 0
+		self.lookups = 0
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.capacity = app.config.get('AVAILABILITY_CAPACITY', 100000)
+		self.error_rate = app.config.get('AVAILABILITY_ERROR_RATE', 0.01)
+		self.refresh = app.config.get('AVAILABILITY_REFRESH', 300)
+		self.invalidate()
+
+	def _build(self):
+		from .models import User
+		rows = self.db.session.query(User.username, User.email)
+		# Room to grow before the error rate degrades, rebuilt when it fills up
+		capacity = max(self.capacity, 2 * rows.count())
+		filters = {field: BloomFilter(capacity, self.error_rate) for field in self.FIELDS}
+		for username, email in rows.yield_per(10000):
+			if username is not None:
+				filters['username'].add(username)
+			if email is not None:
+				filters['email'].add(email)
+		return filters
+
+	def filters(self):
+		filters = self._filters
+		if filters is None or time.monotonic() - self._built > self.refresh or \
+				any(f.count > f.capacity for f in filters.values()):
+			with self._lock:
+				if self._filters is filters:
+					self._filters = self._build()
+					self._built = time.monotonic()
+				filters = self._filters
+		return filters
+
+	def is_taken(self, field, value):
+		from .models import User
+		if value not in self.filters()[field]:
+			self.negatives += 1
+			return False
+		self.lookups += 1
+		column = getattr(User, field)
+		return self.db.session.query(User.id).filter(column == value).first() is not None
+
+	def add(self, **values):
+		# add(username=..., email=...), no-op until the filters are built
+		filters = self._filters
+		if filters is None:
+			return
+		for field, value in values.items():
+			if value is not None:
+				filters[field].add(value)
+
+	def invalidate(self):
+		with self._lock:
+			self._filters = None
+
+	def stats(self):
+		filters = self._filters or {}
+		return {
+			'negatives': self.negatives,
+			'lookups': self.lookups,
+			'entries': {field: f.count for field, f in filters.items()},
+			'bytes': sum(len(f.bits) for f in filters.values())
+		}
@@ -0,0 +1,356 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, request
+
+
+# Verified credential cache
+# Remembers (email, password) pairs that passed check_password_hash so repeat
+# Basic-auth calls skip the PBKDF2 work. Only a keyed digest is stored, with
+# the password hash it was checked against. Invalidation is per process, so a
+# hit only counts while the user row still has that hash.
+class CredentialCache:
+	def __init__(self, app=None):
+		self.max_size = 1024
+		self.ttl = 300
+		self.hits = 0
+		self.misses = 0
+		self._secret = b''
+		self._entries = OrderedDict()  # digest -> (user_id, password_hash, expires)
+		self._by_user = {}  # user_id -> set of digests
+		self._lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.max_size = app.config.get('CREDENTIAL_CACHE_SIZE', self.max_size)
+		self.ttl = app.config.get('CREDENTIAL_CACHE_TTL', self.ttl)
+		self._secret = str(app.config['SECRET_KEY']).encode('utf-8')
+		self.clear()
+
+	def _digest(self, email, password):
+		message = ('%s\x00%s' % (email, password)).encode('utf-8')
+		return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+	def get(self, email, password):
+		if self.max_size <= 0:
+			return None
+		key = self._digest(email, password)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or entry[2] < time.monotonic():
+				if entry is not None:
+					self._remove(key)
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry[0], entry[1]
+
+	def add(self, email, password, user_id, password_hash):
+		if self.max_size <= 0 or user_id is None:
+			return
+		key = self._digest(email, password)
+		with self._lock:
+			self._remove(key)
+			self._entries[key] = (user_id, password_hash, time.monotonic() + self.ttl)
+			self._by_user.setdefault(user_id, set()).add(key)
+			while len(self._entries) > self.max_size:
+				self._remove(next(iter(self._entries)))
+
+	def invalidate(self, user_id):
+		if user_id is None:
+			return
+		with self._lock:
+			for key in self._by_user.pop(user_id, ()):
+				self._entries.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._by_user.clear()
+
+	def stats(self):
+		with self._lock:
+			return {
+				'size': len(self._entries),
+				'max_size': self.max_size,
+				'ttl': self.ttl,
+				'hits': self.hits,
+				'misses': self.misses
+			}
+
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is None:
+			return
+		keys = self._by_user.get(entry[0])
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self._by_user[entry[0]]
+
+
+# Role table cache
+# Roles change rarely, so id -> name is loaded once per process and dropped
+# by the role routes whenever the table is written. Writes in other processes
+# are picked up when it expires after ttl seconds.
+class RoleCache:
+	def __init__(self, loader, ttl=30):
+		self._loader = loader
+		self.ttl = ttl
+		self._names = None
+		self._expires = 0.0
+		self._lock = threading.Lock()
+
+	def name(self, role_id):
+		names = self._names
+		if names is None or self._expires <= time.monotonic():
+			with self._lock:
+				if self._names is names:
+					self._names = self._loader()
+					self._expires = time.monotonic() + self.ttl
+				names = self._names
+		return names.get(role_id)
+
+	def invalidate(self):
+		with self._lock:
+			self._names = None
+
+
+# Built value cache
+# Holds one value built on first use (category tree, ...). invalidate() drops it
+# and bumps version. get(key) also rebuilds when key differs from the key the
+# value was built for, e.g. a version read from the database by another process.
+class BuildCache:
+	def __init__(self, builder):
+		self._builder = builder
+		self._value = None
+		self._key = None
+		self.version = 0
+		self._lock = threading.Lock()
+
+	def get(self, key=None):
+		value = self._value
+		if value is None or key != self._key:
+			with self._lock:
+				if self._value is None or key != self._key:
+					self._value = self._builder()
+					self._key = key
+				value = self._value
+		return value
+
+	def invalidate(self):
+		with self._lock:
+			self._value = None
+			self.version += 1
+
+
+# Per key loader cache
+# get(key) returns loader(key), kept for ttl seconds in a bounded LRU. None
+# results are cached too, so missing keys don't hit the loader every time.
+class LoaderCache:
+	def __init__(self, loader, size=4096, ttl=30):
+		self._loader = loader
+		self.size = size
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry[1] > now:
+				self._entries.move_to_end(key)
+				return entry[0]
+		value = self._loader(key)
+		with self._lock:
+			self._entries[key] = (value, now + self.ttl)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+		return value
+
+	def invalidate(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+
+# Response cache backends
+# Both store (body, meta) under a key and keep tag -> keys sets for invalidation.
+class LRUBackend:
+	def __init__(self, max_size=1024, ttl=60):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._entries = OrderedDict()  # key -> (body, meta, tags, expires)
+		self._tags = {}
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			if entry[3] < time.monotonic():
+				self._remove(key)
+				return None
+			self._entries.move_to_end(key)
+			return entry[0], entry[1]
+
+	def set(self, key, body, meta, tags):
+		with self._lock:
+			self._remove(key)
+			self._entries[key] = (body, meta, tags, time.monotonic() + self.ttl)
+			for tag in tags:
+				self._tags.setdefault(tag, set()).add(key)
+			while len(self._entries) > self.max_size:
+				self._remove(next(iter(self._entries)))
+
+	def invalidate(self, tag):
+		with self._lock:
+			for key in list(self._tags.get(tag, ())):
+				self._remove(key)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._tags.clear()
+
+	def size(self):
+		return len(self._entries)
+
+	def _remove(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is None:
+			return
+		for tag in entry[2]:
+			keys = self._tags.get(tag)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._tags[tag]
+
+
+class RedisBackend:
+	# Shared between processes through a local Redis server (pip install redis)
+	def __init__(self, url='redis://localhost:6379/0', ttl=60, prefix='response:'):
+		import redis
+		self.redis = redis.Redis.from_url(url)
+		self.ttl = ttl
+		self.prefix = prefix
+
+	def get(self, key):
+		body, meta = self.redis.hmget(self.prefix + key, 'body', 'meta')
+		if body is None or meta is None:
+			return None
+		return body, json.loads(meta.decode('utf-8'))
+
+	def set(self, key, body, meta, tags):
+		pipe = self.redis.pipeline()
+		pipe.hset(self.prefix + key, mapping={'body': body, 'meta': json.dumps(meta)})
+		pipe.expire(self.prefix + key, self.ttl)
+		for tag in tags:
+			pipe.sadd(self.prefix + 'tag:' + tag, key)
+			pipe.expire(self.prefix + 'tag:' + tag, self.ttl)
+		pipe.execute()
+
+	def invalidate(self, tag):
+		keys = self.redis.smembers(self.prefix + 'tag:' + tag)
+		pipe = self.redis.pipeline()
+		for key in keys:
+			pipe.delete(self.prefix + key.decode('utf-8'))
+		pipe.delete(self.prefix + 'tag:' + tag)
+		pipe.execute()
+
+	def clear(self):
+		for key in self.redis.scan_iter(self.prefix + '*'):
+			self.redis.delete(key)
+
+	def size(self):
+		return None
+
+
+# Read-through response cache
+# @response_cache.cached('post:{post_id}') stores a view's 200 responses per
+# path and query string. Tags are formatted with the view arguments, the view
+# can add more with response_cache.tag(). Writes call invalidate(tag).
+class ResponseCache:
+	def __init__(self, app=None):
+		self.backend = None
+		self.hits = 0
+		self.misses = 0
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		name = app.config.get('RESPONSE_CACHE_BACKEND', 'lru')
+		ttl = app.config.get('RESPONSE_CACHE_TTL', 60)
+		if name == 'lru':
+			self.backend = LRUBackend(app.config.get('RESPONSE_CACHE_SIZE', 1024), ttl)
+		elif name == 'redis':
+			self.backend = RedisBackend(app.config.get('RESPONSE_CACHE_URL', 'redis://localhost:6379/0'), ttl)
+		else:
+			self.backend = None
+		self.hits = 0
+		self.misses = 0
+
+	def tag(self, *tags):
+		g.setdefault('response_cache_tags', set()).update(tags)
+
+	def invalidate(self, *tags):
+		if self.backend is not None:
+			for tag in tags:
+				self.backend.invalidate(str(tag))
+
+	def clear(self):
+		if self.backend is not None:
+			self.backend.clear()
+
+	def stats(self):
+		total = self.hits + self.misses
+		return {
+			'backend': type(self.backend).__name__ if self.backend is not None else None,
+			'size': self.backend.size() if self.backend is not None else 0,
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_ratio': self.hits / total if total else 0.0
+		}
+
+	def cached(self, *tags):
+		def decorator(f):
+			@wraps(f)
+			def decorated_function(*args, **kwargs):
+				if self.backend is None or request.method != 'GET':
+					return f(*args, **kwargs)
+
+				# Views pick the encoding from Accept, so it is part of the key
+				key = '%s %s' % (request.full_path, request.headers.get('Accept', '*/*'))
+				entry = self.backend.get(key)
+				if entry is not None:
+					self.hits += 1
+					body, meta = entry
+					response = current_app.response_class(body, status=meta['status'], headers=meta['headers'])
+					return response.make_conditional(request)
+
+				self.misses += 1
+				response = current_app.make_response(f(*args, **kwargs))
+				if response.status_code == 200 and not response.is_streamed:
+					g.setdefault('response_cache_tags', set()).update(
+						tag.format(**kwargs) for tag in tags
+					)
+					meta = {
+						'status': response.status_code,
+						'headers': [
+							(name, value) for name, value in response.headers
+							if name in ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+						]
+					}
+					self.backend.set(key, response.get_data(), meta, sorted(g.response_cache_tags))
+				return response
+			return decorated_function
+		return decorator
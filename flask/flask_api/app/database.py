@@ -0,0 +1,116 @@
+import itertools
+import sqlite3
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+
+# Engine tuning from the app config
+# SQLALCHEMY_ENGINE_OPTIONS carries the pool settings (pool_size, max_overflow,
+# pool_recycle, pool_pre_ping). SQLite file databases get a real QueuePool
+# when pool_size is set instead of a new connection per checkout, and
+# SQLITE_PRAGMAS is run on every new connection.
+# READ_REPLICAS adds one bind per replica URI, views marked with
+# @db.read_replica read from them round-robin, see RoutingSession.
+class Database(SQLAlchemy):
+	POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+	def init_app(self, app):
+		replicas = app.config.get('READ_REPLICAS') or []
+		if replicas:
+			binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+			for i, uri in enumerate(replicas):
+				binds['replica%d' % i] = uri
+			app.config['SQLALCHEMY_BINDS'] = binds
+		app.extensions['read_replicas'] = itertools.cycle(
+			['replica%d' % i for i in range(len(replicas))]
+		) if replicas else None
+		super(Database, self).init_app(app)
+
+	def create_session(self, options):
+		return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+	def read_replica(self, f):
+		'''View decorator, its reads may go to a replica'''
+		@wraps(f)
+		def decorated(*args, **kwargs):
+			g.read_replica = True
+			return f(*args, **kwargs)
+		return decorated
+
+	def apply_driver_hacks(self, app, sa_url, options):
+		super(Database, self).apply_driver_hacks(app, sa_url, options)
+		pragmas = app.config.get('SQLITE_PRAGMAS')
+		if sa_url.drivername == 'sqlite' and pragmas:
+			options['sqlite_pragmas'] = pragmas
+
+	def create_engine(self, sa_url, engine_opts):
+		# engine_opts already has SQLALCHEMY_ENGINE_OPTIONS merged in
+		pragmas = engine_opts.pop('sqlite_pragmas', None)
+		if sa_url.drivername == 'sqlite':
+			if sa_url.database in (None, '', ':memory:'):
+				# StaticPool, one shared connection
+				for name in self.POOL_OPTIONS:
+					engine_opts.pop(name, None)
+			elif engine_opts.get('pool_size'):
+				engine_opts['poolclass'] = QueuePool
+				# A pooled connection is used by one thread at a time, not always the same one
+				engine_opts.setdefault('connect_args', {})['check_same_thread'] = False
+		engine = super(Database, self).create_engine(sa_url, engine_opts)
+		if pragmas:
+			event.listen(engine, 'connect', sqlite_pragmas(pragmas))
+		return engine
+
+
+def sqlite_pragmas(pragmas):
+	# Pragma names and values come from the config, not from requests
+	statements = ['PRAGMA %s = %s' % (name, value) for name, value in pragmas.items()]
+
+	def on_connect(dbapi_connection, connection_record):
+		cursor = dbapi_connection.cursor()
+		for statement in statements:
+			cursor.execute(statement)
+		cursor.close()
+
+	return on_connect
+
+
+def copy_sqlite(source, target):
+	'''Copy one SQLite database file to another with the online backup API.'''
+	source = sqlite3.connect(source)
+	target = sqlite3.connect(target)
+	try:
+		source.backup(target)
+	finally:
+		target.close()
+		source.close()
+
+
+# Session routing
+# Primary unless the view is marked read_replica. Flushes, Core writes and
+# every query after them in the same request stay on the primary, so a view
+# reads its own writes. One replica per session, picked round-robin.
+class RoutingSession(SignallingSession):
+	def __init__(self, db, **options):
+		self.db = db
+		super(RoutingSession, self).__init__(db, **options)
+
+	def get_bind(self, mapper=None, clause=None):
+		if self._flushing or isinstance(clause, UpdateBase):
+			self.info['wrote'] = True
+		elif not self.info.get('wrote'):
+			replica = self.replica()
+			if replica is not None:
+				return self.db.get_engine(self.app, bind=replica)
+		return super(RoutingSession, self).get_bind(mapper, clause)
+
+	def replica(self):
+		if not (has_app_context() and g.get('read_replica')):
+			return None
+		if 'replica' not in self.info:
+			replicas = self.app.extensions.get('read_replicas')
+			self.info['replica'] = next(replicas) if replicas is not None else None
+		return self.info['replica']
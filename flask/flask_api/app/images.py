@@ -0,0 +1,127 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+
+# Post images
+# Originals are stored under their SHA-256, so a file never changes once
+# written and the same upload is kept once. Resized variants are rendered in a
+# process pool after the request returned, and recorded on the post when
+# done. Needs Pillow, imported when first used.
+#
+#	<IMAGE_STORE_PATH>/originals/ab/abcdef....png
+#	<IMAGE_STORE_PATH>/variants/thumb/ab/abcdef....jpg
+class ImageStore:
+	def __init__(self, db=None, app=None):
+		self.db = db
+		self.root = None
+		self.variants = {}
+		self.workers = 0
+		self._pool = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.root = app.config.get('IMAGE_STORE_PATH') or os.path.join(app.instance_path, 'images')
+		self.variants = dict(app.config.get('IMAGE_VARIANTS', {}))
+		self.workers = app.config.get('IMAGE_WORKERS', 2)
+
+	@property
+	def pool(self):
+		if self._pool is None:
+			self._pool = ProcessPoolExecutor(max_workers=self.workers)
+		return self._pool
+
+	def save(self, data):
+		'''Store an uploaded image, returns its path in the store. ValueError if it is not an image.'''
+		from PIL import Image
+		try:
+			with Image.open(io.BytesIO(data)) as image:
+				extension = (image.format or '').lower()
+				image.verify()
+		except Exception:
+			raise ValueError('Not an image')
+		if extension not in ('jpeg', 'png', 'gif', 'webp'):
+			raise ValueError('Unsupported image format')
+
+		digest = hashlib.sha256(data).hexdigest()
+		path = 'originals/%s/%s.%s' % (digest[:2], digest, extension)
+		if not os.path.exists(os.path.join(self.root, path)):
+			write_atomic(os.path.join(self.root, path), data)
+		return path
+
+	def render(self, app, post_id, original):
+		'''Render the variants of original off the request, then record them on the post.'''
+		if not self.workers:
+			# Inline, in the request: its session and app context are used as they are
+			self._record(post_id, original, render_variants(self.root, original, self.variants))
+			return
+		future = self.pool.submit(render_variants, self.root, original, self.variants)
+
+		def done(future):
+			error = future.exception()
+			if error is not None:
+				app.logger.error('Image variants for post %s failed: %s', post_id, error)
+				return
+			# Callback thread, own app context and session
+			with app.app_context():
+				try:
+					self._record(post_id, original, future.result())
+				finally:
+					self.db.session.remove()
+
+		future.add_done_callback(done)
+
+	def _record(self, post_id, original, variants):
+		from .models import Post
+		from . import response_cache
+		# Only if the post still shows this image, a newer upload wins.
+		# date_modified moves too, it is what the post's ETag is built from.
+		self.db.session.query(Post).filter(Post.id == post_id, Post.image == original).update({
+			'image_variants': json.dumps(variants, sort_keys=True),
+			'date_modified': datetime.utcnow()
+		}, synchronize_session=False)
+		self.db.session.commit()
+		response_cache.invalidate('post:%s' % post_id)
+
+
+def write_atomic(path, data):
+	# Readers never see a half written file
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+	try:
+		with os.fdopen(handle, 'wb') as f:
+			f.write(data)
+		os.replace(temporary, path)
+	except BaseException:
+		os.unlink(temporary)
+		raise
+
+
+def render_variants(root, original, variants):
+	'''Runs in a worker process: {name: path} of the resized copies.'''
+	from PIL import Image, ImageOps
+	digest = os.path.basename(original).split('.')[0]
+	paths = {}
+	with Image.open(os.path.join(root, original)) as image:
+		image = ImageOps.exif_transpose(image)
+		alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+		for name, size in sorted(variants.items()):
+			copy = image.copy()
+			copy.thumbnail(tuple(size))
+			output = io.BytesIO()
+			if alpha:
+				extension = 'png'
+				copy.convert('RGBA').save(output, 'PNG', optimize=True)
+			else:
+				extension = 'jpg'
+				copy.convert('RGB').save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+			path = 'variants/%s/%s/%s.%s' % (name, digest[:2], digest, extension)
+			if not os.path.exists(os.path.join(root, path)):
+				write_atomic(os.path.join(root, path), output.getvalue())
+			paths[name] = path
+	return paths
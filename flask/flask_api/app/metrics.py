@@ -0,0 +1,148 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Per endpoint request metrics
+# Counts requests, latency histogram, SQL queries and time spent in the
+# database and in serialization. Rendered as Prometheus text by /api/_metrics,
+# and as a Server-Timing header when METRICS_SERVER_TIMING is set.
+class Metrics:
+	BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+	def __init__(self, app=None):
+		self.server_timing = False
+		self._endpoints = {}
+		self._collectors = []
+		self._lock = threading.Lock()
+		self._listening = False
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.server_timing = app.config.get('METRICS_SERVER_TIMING', False)
+		app.before_request(self._before_request)
+		app.after_request(self._after_request)
+		if not self._listening:
+			event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+			event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+			self._listening = True
+
+	def add_collector(self, collector):
+		# collector() returns a list of (name, type, help, value) samples
+		self._collectors.append(collector)
+
+	@contextmanager
+	def phase(self, name):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			if has_app_context() and 'metrics_phases' in g:
+				phases = g.metrics_phases
+				phases[name] = phases.get(name, 0.0) + time.perf_counter() - started
+
+	def timed(self, name):
+		def decorator(f):
+			@wraps(f)
+			def decorated_function(*args, **kwargs):
+				with self.phase(name):
+					return f(*args, **kwargs)
+			return decorated_function
+		return decorator
+
+	def _before_request(self):
+		g.metrics_start = time.perf_counter()
+		g.metrics_queries = 0
+		g.metrics_phases = {'db': 0.0}
+
+	def _after_request(self, response):
+		if 'metrics_start' not in g:
+			return response
+		duration = time.perf_counter() - g.metrics_start
+		phases = g.metrics_phases
+		endpoint = request.endpoint or 'unknown'
+
+		with self._lock:
+			stats = self._endpoints.get(endpoint)
+			if stats is None:
+				stats = self._endpoints[endpoint] = {
+					'status': {},
+					'buckets': [0] * len(self.BUCKETS),
+					'count': 0,
+					'sum': 0.0,
+					'queries': 0,
+					'phases': {}
+				}
+			status = (request.method, response.status_code)
+			stats['status'][status] = stats['status'].get(status, 0) + 1
+			for i, bound in enumerate(self.BUCKETS):
+				if duration <= bound:
+					stats['buckets'][i] += 1
+			stats['count'] += 1
+			stats['sum'] += duration
+			stats['queries'] += g.metrics_queries
+			for name, seconds in phases.items():
+				stats['phases'][name] = stats['phases'].get(name, 0.0) + seconds
+
+		if self.server_timing:
+			timings = ['%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in phases.items()]
+			timings.append('total;dur=%.2f' % (duration * 1000))
+			response.headers['Server-Timing'] = ', '.join(timings)
+		return response
+
+	def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		conn.info['metrics_query_start'] = time.perf_counter()
+
+	def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+		started = conn.info.pop('metrics_query_start', None)
+		if started is not None and has_app_context() and 'metrics_phases' in g:
+			g.metrics_queries += 1
+			g.metrics_phases['db'] += time.perf_counter() - started
+
+	def render(self):
+		lines = []
+
+		def header(name, kind, description):
+			lines.append('# HELP %s %s' % (name, description))
+			lines.append('# TYPE %s %s' % (name, kind))
+
+		with self._lock:
+			endpoints = sorted(self._endpoints.items())
+
+			header('api_requests_total', 'counter', 'Requests by endpoint, method and status.')
+			for endpoint, stats in endpoints:
+				for (method, status), count in sorted(stats['status'].items()):
+					lines.append('api_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (
+						endpoint, method, status, count))
+
+			header('api_request_duration_seconds', 'histogram', 'Request latency.')
+			for endpoint, stats in endpoints:
+				for bound, count in zip(self.BUCKETS, stats['buckets']):
+					lines.append('api_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (
+						endpoint, bound, count))
+				lines.append('api_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (
+					endpoint, stats['count']))
+				lines.append('api_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, stats['sum']))
+				lines.append('api_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, stats['count']))
+
+			header('api_db_queries_total', 'counter', 'SQL statements executed.')
+			for endpoint, stats in endpoints:
+				lines.append('api_db_queries_total{endpoint="%s"} %d' % (endpoint, stats['queries']))
+
+			header('api_phase_seconds_total', 'counter', 'Time spent in the database (db) and serialization.')
+			for endpoint, stats in endpoints:
+				for name, seconds in sorted(stats['phases'].items()):
+					lines.append('api_phase_seconds_total{endpoint="%s",phase="%s"} %f' % (
+						endpoint, name, seconds))
+
+		for collector in self._collectors:
+			for name, kind, description, value in collector():
+				header(name, kind, description)
+				lines.append('%s %s' % (name, value))
+
+		return '\n'.join(lines) + '\n'
@@ -1,10 +1,31 @@
-from . import db, login_manager
+from . import db, login_manager, credential_cache, search_index, availability
+from app.cache import RoleCache, BuildCache, LoaderCache
 from app.exceptions import ValidationError
 from datetime import datetime
+from flask import current_app
 from flask_login import UserMixin, AnonymousUserMixin, current_user
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event
+import hashlib
+import hmac
+import json
+from werkzeug.http import http_date
 from werkzeug.security import check_password_hash, generate_password_hash
 
 
+def json_fields(values, fields=None):
+	# values: field -> callable, only the fields asked for are evaluated, so
+	# columns left out of the query are never lazy loaded
+	if fields is None:
+		return {name: value() for name, value in values.items()}
+	return {name: values[name]() for name in fields}
+
+
+def image_url(path):
+	# IMAGE_URL can point at a CDN in front of the image store
+	return current_app.config.get('IMAGE_URL', '/api/images/') + path
+
+
 # Category parent/child relation
 category_tree_table = db.Table(
 	'category_tree',
@@ -12,6 +33,15 @@ category_tree_table = db.Table(
 	db.Column('children_id', db.Integer, db.ForeignKey('categories.id'))
 )
 
+# Category hierarchy index, one row per (ancestor, descendant) pair.
+# Rebuilt from category_tree by Category.changed()
+category_closure_table = db.Table(
+	'category_closure',
+	db.Column('ancestor_id', db.Integer, db.ForeignKey('categories.id'), primary_key=True),
+	db.Column('descendant_id', db.Integer, db.ForeignKey('categories.id'), primary_key=True, index=True),
+	db.Column('depth', db.Integer)
+)
+
 
 class User(UserMixin, db.Model):
 	__tablename__ = 'users'
@@ -19,6 +49,8 @@ class User(UserMixin, db.Model):
 	username = db.Column(db.String(128), index=True, unique=True)
 	email = db.Column(db.String(128), index=True, unique=True)
 	password_hash = db.Column(db.String(128))
+	# Bumped to revoke every token issued so far
+	token_version = db.Column(db.Integer, default=0)
 
 	role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), index=True)
 	posts = db.relationship('Post', backref='author', lazy='dynamic')
@@ -38,19 +70,21 @@ class User(UserMixin, db.Model):
 	@password.setter
 	def password(self, password):
 		self.password_hash = generate_password_hash(password)
+		credential_cache.invalidate(self.id)
+		self.revoke_tokens()
 
 	def verify_password(self, password):
 		return check_password_hash(self.password_hash, password)
 
-	def to_json(self):
-		json_user = {
-			'username': self.username,
-			'email': self.email,
-			'role': self.role.to_json() if self.role is not None else '',
-			'posts': [post.to_json() for post in self.posts],
-			'categories': ''
-		}
-		return json_user
+	def to_json(self, posts=None, fields=None):
+		# posts: preloaded list, fields: sparse fieldset, see api/serializers.py
+		return json_fields({
+			'username': lambda: self.username,
+			'email': lambda: self.email,
+			'role': lambda: self.role.to_json() if self.role is not None else '',
+			'posts': lambda: [post.to_json(Post.LISTING_FIELDS) for post in (self.posts if posts is None else posts)],
+			'categories': lambda: ''
+		}, fields)
 
 	@staticmethod
 	def from_json(json_user):
@@ -65,6 +99,61 @@ class User(UserMixin, db.Model):
 		else:
 			return None
 
+	# Signed tokens carry id, role name, token version and a fingerprint of the
+	# password hash. The fingerprint ties a token to this account, a deleted
+	# user's id may be reused by the next one. Version and fingerprint are
+	# looked up through the token_versions cache.
+	@staticmethod
+	def token_serializer():
+		return URLSafeTimedSerializer(
+			current_app.config['SECRET_KEY'],
+			salt='api-token',
+			signer_kwargs={'digest_method': hashlib.sha256}
+		)
+
+	@staticmethod
+	def token_fingerprint(password_hash):
+		key = current_app.config['SECRET_KEY'].encode('utf-8')
+		return hmac.new(key, (password_hash or '').encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+	def generate_auth_token(self):
+		return User.token_serializer().dumps({
+			'id': self.id,
+			'role': self.get_role(),
+			'v': self.token_version or 0,
+			'f': User.token_fingerprint(self.password_hash)
+		})
+
+	@staticmethod
+	def verify_auth_token(token, max_age):
+		try:
+			data = User.token_serializer().loads(token, max_age=max_age)
+		except BadSignature:  # Also expired
+			return None
+		if token_versions.get(data['id']) != (data['v'], data.get('f')):
+			return None  # Revoked, password changed or user deleted
+		return data
+
+	def revoke_tokens(self):
+		self.token_version = (self.token_version or 0) + 1
+		token_versions.invalidate(self.id)
+
+	@staticmethod
+	def load_token_version(user_id):
+		# (version, fingerprint), None if the user is gone
+		row = db.session.query(User.token_version, User.password_hash).filter(User.id == user_id).first()
+		if row is None:
+			return None
+		return (row[0] or 0, User.token_fingerprint(row[1]))
+
+	@staticmethod
+	def load_identity(email=None, user_id=None):
+		# User and role in one joined query
+		query = User.query.options(db.joinedload(User.role))
+		if user_id is not None:
+			return query.filter(User.id == user_id).first()
+		return query.filter(User.email == email).first()
+
 	@staticmethod
 	def generate_fake_data(quantity):
 		import forgery_py
@@ -117,6 +206,16 @@ class Role(db.Model):
 		user = Role(name='user', default=True)
 		db.session.add_all([admin, moderator, user])
 		db.session.commit()
+		role_cache.invalidate()
+
+	@staticmethod
+	def load_names():
+		return dict(db.session.query(Role.id, Role.name).all())
+
+
+role_cache = RoleCache(Role.load_names, ttl=30)
+# Revocation reaches other processes within ttl seconds
+token_versions = LoaderCache(User.load_token_version, ttl=30)
 
 
 class Permission(db.Model):
@@ -152,26 +251,74 @@ class Post(db.Model):
 	id = db.Column(db.Integer, index=True, primary_key=True)
 	title = db.Column(db.String(128), index=True, unique=True)
 	slug = db.Column(db.String(128), index=True, unique=True)
-	body = db.Column(db.Text)
+	# Only loaded when asked for, listings use summary
+	body = db.deferred(db.Column(db.Text))
+	summary = db.Column(db.String(300))
+	word_count = db.Column(db.Integer)
 	timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 	date_modified = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+	# Original in the image store, variants as JSON {name: path} once rendered
 	image = db.Column(db.String())
+	image_variants = db.Column(db.Text)
 	moderator = db.Column(db.String(128))
 
 	author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
-	def to_json(self):
-		json_post = {
-			'title': self.title if self.title is not None else '',
-			'slug': self.slug if self.slug is not None else '',
-			'body': self.body if self.body is not None else '',
-			'timestamp': self.timestamp if self.timestamp is not None else '',
-			'image': self.image if self.image is not None else '',
-			'author': self.author.username,
-			'date_modified': self.date_modified if self.date_modified is not None else '',
-			'moderator': self.moderator if self.moderator is not None else ''
-		}
-		return json_post
+	def to_json(self, fields=None):
+		return json_fields({
+			'title': lambda: self.title if self.title is not None else '',
+			'slug': lambda: self.slug if self.slug is not None else '',
+			'body': lambda: self.body if self.body is not None else '',
+			'timestamp': lambda: http_date(self.timestamp) if self.timestamp is not None else '',
+			'image': lambda: image_url(self.image) if self.image else '',
+			'images': lambda: {
+				name: image_url(path) for name, path in json.loads(self.image_variants or '{}').items()
+			},
+			'author': lambda: self.author.username if self.author is not None else '',
+			'date_modified': lambda: http_date(self.date_modified) if self.date_modified is not None else '',
+			'moderator': lambda: self.moderator if self.moderator is not None else '',
+			'summary': lambda: self.summary if self.summary is not None else '',
+			'word_count': lambda: self.word_count if self.word_count is not None else 0
+		}, fields)
+
+	# Fields for listings, everything but the body
+	LISTING_FIELDS = (
+		'title', 'slug', 'summary', 'word_count', 'timestamp', 'image', 'images', 'author', 'date_modified',
+		'moderator'
+	)
+	SUMMARY_LENGTH = 280
+
+	@staticmethod
+	def summarize(body):
+		'''(summary, word_count) for a body, the summary is cut at a word.'''
+		if not body:
+			return '', 0
+		words = body.split()
+		summary = ' '.join(words)
+		if len(summary) > Post.SUMMARY_LENGTH:
+			cut = summary.rfind(' ', 0, Post.SUMMARY_LENGTH)
+			summary = summary[:cut if cut > 0 else Post.SUMMARY_LENGTH].rstrip(',.;:!?') + '...'
+		return summary, len(words)
+
+	@staticmethod
+	def backfill_summaries(batch_size=1000):
+		'''Fill summary and word_count where missing, returns the number of posts.'''
+		table = Post.__table__
+		update = table.update().where(table.c.id == db.bindparam('post_id')).values(
+			summary=db.bindparam('summary'), word_count=db.bindparam('word_count')
+		)
+		count = 0
+		while True:
+			rows = db.session.query(Post.id, Post.body).filter(Post.summary.is_(None)).limit(batch_size).all()
+			if not rows:
+				return count
+			batch = []
+			for post_id, body in rows:
+				summary, word_count = Post.summarize(body)
+				batch.append({'post_id': post_id, 'summary': summary, 'word_count': word_count})
+			db.session.execute(update, batch)
+			db.session.commit()
+			count += len(batch)
 
 	@staticmethod
 	def generate_fake_data(quantity):
@@ -200,6 +347,19 @@ class Post(db.Model):
 				db.session.rollback()
 
 
+# New and changed usernames/emails go into the availability filters, a write
+# that later rolls back only leaves a false positive behind
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def user_written(mapper, connection, user):
+	availability.add(username=user.username, email=user.email)
+
+
+@event.listens_for(Post.body, 'set')
+def post_body_set(post, body, old_body, initiator):
+	post.summary, post.word_count = Post.summarize(body)
+
+
 # http --json localhost:5000/api/categories/
 class Category(db.Model):
 	__tablename__ = 'categories'
@@ -215,6 +375,9 @@ class Category(db.Model):
 	custom_template = db.Column(db.Boolean, default=False)
 	custom_template_url = db.Column(db.String(128), default='')
 
+	# Date modified: Last change, together with the row count it versions the whole table
+	date_modified = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 	# list for children to category
 	children = db.relationship(
 		'Category',
@@ -225,16 +388,126 @@ class Category(db.Model):
 		lazy='dynamic'
 	)
 
-	def to_json(self):
-		json_category = {
-			'priority': self.priority,
-			'display_name': self.display_name,
-			'custom_template': self.custom_template,
-			'custom_template_url': self.custom_template_url,
-			'children': [child.display_name for child in self.children],
-			'parents': [parent.display_name for parent in self.parents]
+	def to_json(self, children=None, parents=None, fields=None):
+		# children/parents: preloaded display names, see api/serializers.py
+		return json_fields({
+			'priority': lambda: self.priority,
+			'display_name': lambda: self.display_name,
+			'custom_template': lambda: self.custom_template,
+			'custom_template_url': lambda: self.custom_template_url,
+			'children': lambda: [child.display_name for child in self.children] if children is None else children,
+			'parents': lambda: [parent.display_name for parent in self.parents] if parents is None else parents
+		}, fields)
+
+	def ancestors(self):
+		return Category.query.join(
+			category_closure_table, category_closure_table.c.ancestor_id == Category.id
+		).filter(
+			category_closure_table.c.descendant_id == self.id
+		).order_by(category_closure_table.c.depth.desc())
+
+	def descendants(self):
+		return Category.query.join(
+			category_closure_table, category_closure_table.c.descendant_id == Category.id
+		).filter(
+			category_closure_table.c.ancestor_id == self.id
+		).order_by(category_closure_table.c.depth)
+
+	@staticmethod
+	def version():
+		# (row count, last change) in one aggregate query, used for ETags
+		return db.session.query(
+			db.func.count(Category.id), db.func.max(Category.date_modified)
+		).one()
+
+	@staticmethod
+	def changed():
+		# Call after any category or category_tree write
+		Category.rebuild_closure()
+		category_tree.invalidate()
+
+	@staticmethod
+	def links():
+		# parent id -> child ids, straight from category_tree
+		children = {}
+		for parent_id, child_id in db.session.query(
+				category_tree_table.c.parent_id, category_tree_table.c.children_id):
+			children.setdefault(parent_id, []).append(child_id)
+		return children
+
+	@staticmethod
+	def in_cycle(category_id):
+		# True if category_id is below itself in category_tree, flushed links included
+		children = Category.links()
+		seen = set()
+		queue = list(children.get(category_id, ()))
+		for node in queue:
+			if node == category_id:
+				return True
+			if node not in seen:
+				seen.add(node)
+				queue.extend(children.get(node, ()))
+		return False
+
+	@staticmethod
+	def rebuild_closure():
+		children = Category.links()
+
+		# Breadth first from every node gives the shortest depth, cycles are skipped
+		rows = []
+		for ancestor_id in children:
+			depth = {ancestor_id: 0}
+			queue = [ancestor_id]
+			for node in queue:
+				for child_id in children.get(node, ()):
+					if child_id not in depth:
+						depth[child_id] = depth[node] + 1
+						queue.append(child_id)
+			rows.extend(
+				{'ancestor_id': ancestor_id, 'descendant_id': descendant_id, 'depth': d}
+				for descendant_id, d in depth.items() if d > 0
+			)
+
+		db.session.execute(category_closure_table.delete())
+		if rows:
+			db.session.execute(category_closure_table.insert(), rows)
+		db.session.commit()
+
+	@staticmethod
+	def build_tree():
+		# Whole navbar tree from two queries, siblings sorted by priority
+		nodes = {
+			category.id: {
+				'id': category.id,
+				'priority': category.priority,
+				'display_name': category.display_name,
+				'custom_template': category.custom_template,
+				'custom_template_url': category.custom_template_url,
+				'children': []
+			}
+			for category in Category.query.all()
 		}
-		return json_category
+		children = {}
+		has_parent = set()
+		for parent_id, child_id in db.session.query(
+				category_tree_table.c.parent_id, category_tree_table.c.children_id):
+			if parent_id in nodes and child_id in nodes:
+				children.setdefault(parent_id, []).append(child_id)
+				has_parent.add(child_id)
+
+		def order(ids):
+			return sorted(ids, key=lambda i: (nodes[i]['priority'] or 0, nodes[i]['display_name'] or ''))
+
+		def build(category_id, path):
+			node = dict(nodes[category_id])
+			node['children'] = [
+				build(child_id, path | {child_id})
+				for child_id in order(children.get(category_id, ()))
+				if child_id not in path
+			]
+			return node
+
+		return [build(i, {i}) for i in order(i for i in nodes if i not in has_parent)]
 
 	@staticmethod
 	def generate_fake_data(quantity):
@@ -256,6 +529,9 @@ class Category(db.Model):
 				db.session.rollback()
 
 
+category_tree = BuildCache(Category.build_tree)
+
+
 class Tag(db.Model):
 	__tablename__ = 'tags'
 	id = db.Column(db.Integer, index=True, primary_key=True)
@@ -306,9 +582,12 @@ def generate_fake_data():
 	Permission.generate_fake_data(10)
 	print("Adding fake categories")
 	Category.generate_fake_data(10)
+	Category.changed()
 	print("Adding fake tags")
 	Tag.generate_fake_data(10)
 	print("Adding fake posts")
 	Post.generate_fake_data(20)
+	search_index.rebuild()
+	db.session.commit()
 
 	print("Done")
@@ -0,0 +1,162 @@
+import re
+from sqlalchemy import text
+
+
+# Post search index
+# SearchIndex picks a backend from the database URI: SQLite gets a real FTS5
+# inverted index, anything else falls back to a LIKE scan. Backends only deal
+# in post ids, the api loads and serializes the posts.
+class SearchIndex:
+	def __init__(self, db=None, app=None):
+		self.db = db
+		self.backend = None
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		name = app.config.get('SEARCH_BACKEND')
+		if name is None:
+			uri = app.config.get('SQLALCHEMY_DATABASE_URI', '')
+			name = 'fts5' if uri.startswith('sqlite') else 'like'
+		self.backend = BACKENDS[name](self.db)
+
+	def index(self, post):
+		self.backend.ensure()
+		self.backend.index(post)
+
+	def index_many(self, rows):
+		'''New posts as dicts with id, title and body'''
+		self.backend.ensure()
+		self.backend.index_many(rows)
+
+	def remove(self, post_id):
+		self.backend.ensure()
+		self.backend.remove(post_id)
+
+	def search(self, query, limit, offset=0):
+		'''[(post_id, snippet), ...] best match first'''
+		self.backend.ensure()
+		return self.backend.search(query, limit, offset)
+
+	def rebuild(self):
+		self.backend.ensure()
+		self.backend.rebuild()
+
+
+class LikeBackend:
+	# No index, searches the posts table directly
+	def __init__(self, db):
+		self.db = db
+
+	def ensure(self):
+		pass
+
+	def index(self, post):
+		pass
+
+	def index_many(self, rows):
+		pass
+
+	def remove(self, post_id):
+		pass
+
+	def rebuild(self):
+		pass
+
+	def search(self, query, limit, offset=0):
+		from .models import Post
+		words = query.split()
+		if not words:
+			return []
+		filters = [
+			self.db.or_(Post.title.ilike('%' + word + '%'), Post.body.ilike('%' + word + '%'))
+			for word in words
+		]
+		rows = self.db.session.query(Post.id, Post.body).filter(*filters).order_by(
+			Post.id.desc()
+		).limit(limit).offset(offset).all()
+		return [(post_id, self.snippet(body or '', words[0])) for post_id, body in rows]
+
+	@staticmethod
+	def snippet(body, word, width=80):
+		start = body.lower().find(word.lower())
+		if start < 0:
+			return body[:width]
+		start = max(0, start - width // 2)
+		return ('...' if start else '') + body[start:start + width] + '...'
+
+
+class Fts5Backend:
+	# rowid of posts_fts is the post id, title hits weigh more than body hits
+	TABLE = 'posts_fts'
+
+	def __init__(self, db):
+		self.db = db
+		self.ready = False
+
+	def ensure(self):
+		if self.ready:
+			return
+		exists = self.db.session.execute(text(
+			"SELECT name FROM sqlite_master WHERE type='table' AND name=:name"
+		), {'name': self.TABLE}).first()
+		if exists is None:
+			self.db.session.execute(text(
+				"CREATE VIRTUAL TABLE %s USING fts5(title, body, tokenize='porter unicode61')" % self.TABLE
+			))
+			self.rebuild()
+			self.db.session.commit()
+		self.ready = True
+
+	def index(self, post):
+		self.remove(post.id)
+		self.db.session.execute(text(
+			"INSERT INTO %s (rowid, title, body) VALUES (:id, :title, :body)" % self.TABLE
+		), {'id': post.id, 'title': post.title or '', 'body': post.body or ''})
+
+	def index_many(self, rows):
+		if not rows:
+			return
+		self.db.session.execute(text(
+			"INSERT INTO %s (rowid, title, body) VALUES (:id, :title, :body)" % self.TABLE
+		), [{'id': row['id'], 'title': row['title'] or '', 'body': row['body'] or ''} for row in rows])
+
+	def remove(self, post_id):
+		self.db.session.execute(text(
+			"DELETE FROM %s WHERE rowid = :id" % self.TABLE
+		), {'id': post_id})
+
+	def rebuild(self):
+		self.db.session.execute(text("DELETE FROM %s" % self.TABLE))
+		self.db.session.execute(text(
+			"INSERT INTO %s (rowid, title, body) "
+			"SELECT id, coalesce(title, ''), coalesce(body, '') FROM posts" % self.TABLE
+		))
+
+	@staticmethod
+	def match_expression(query):
+		# User input as quoted terms, so FTS5 operators in it are not parsed.
+		# The last term matches as a prefix for search-as-you-type.
+		words = re.findall(r'\w+', query)
+		if not words:
+			return None
+		terms = ['"%s"' % word for word in words]
+		terms[-1] += '*'
+		return ' '.join(terms)
+
+	def search(self, query, limit, offset=0):
+		expression = self.match_expression(query)
+		if expression is None:
+			return []
+		rows = self.db.session.execute(text(
+			"SELECT rowid, snippet({0}, 1, '[', ']', '...', 16) FROM {0} "
+			"WHERE {0} MATCH :query ORDER BY bm25({0}, 10.0, 1.0) "
+			"LIMIT :limit OFFSET :offset".format(self.TABLE)
+		), {'query': expression, 'limit': limit, 'offset': offset}).fetchall()
+		return [(post_id, snippet) for post_id, snippet in rows]
+
+
+BACKENDS = {
+	'fts5': Fts5Backend,
+	'like': LikeBackend
+}
@@ -0,0 +1,146 @@
+from . import db, search_index, availability
+from .models import User, Role, Post, Category, Tag, Permission, category_tree_table
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+import random
+import time
+
+
+'''
+Bulk seeding for load testing
+
+	python manage.py seed --scale large --seed 1
+
+Unlike generate_fake_data (one commit per row), rows are built in Python and
+written with Core insert executemany in large transactions. Unique fields get
+a running number instead of relying on IntegrityError, and post authors are
+drawn from a preloaded id list. The same seed gives the same data.
+Every seeded user has the password given by password.
+'''
+
+SCALES = {
+	'tiny': dict(users=100, posts=500, categories=10, tags=10, permissions=10),
+	'small': dict(users=1000, posts=10000, categories=20, tags=50, permissions=10),
+	'medium': dict(users=100000, posts=200000, categories=50, tags=200, permissions=20),
+	'large': dict(users=1000000, posts=1000000, categories=100, tags=500, permissions=20),
+}
+
+# Timestamps are spread from here, so they don't depend on when seeding ran
+EPOCH = datetime(2020, 1, 1)
+
+
+def _insert(table, rows, batch_size):
+	# rows is a generator, one executemany per batch, one transaction for all
+	count = 0
+	with db.engine.begin() as connection:
+		batch = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= batch_size:
+				connection.execute(table.insert(), batch)
+				count += len(batch)
+				batch = []
+		if batch:
+			connection.execute(table.insert(), batch)
+			count += len(batch)
+	return count
+
+
+def _report(name, count, started):
+	elapsed = time.perf_counter() - started
+	print('%s: %d rows in %.2fs (%.0f rows/s)' % (name, count, elapsed, count / elapsed if elapsed else 0))
+
+
+def seed_bulk(users=1000, posts=10000, categories=20, tags=50, permissions=10,
+			seed=0, batch_size=10000, password='123456', pool_size=500):
+	import forgery_py
+	from slugify import slugify
+
+	rng = random.Random(seed)
+	random.seed(seed)  # forgery_py draws from the random module
+
+	db.drop_all()
+	db.create_all()
+	Role.insert_roles()
+	admin_role = Role.query.filter_by(name='admin').first()
+	default_role = Role.query.filter_by(default=True).first()
+	admin_user = User(
+		username='admin',
+		password='123456',
+		email='admin@admin.admin',
+		role=admin_role
+	)
+	db.session.add(admin_user)
+	db.session.commit()
+
+	# Small pools of fake text, made unique with a running number
+	names = [forgery_py.internet.user_name() for i in range(pool_size)]
+	domains = [forgery_py.internet.domain_name() for i in range(pool_size)]
+	titles = [forgery_py.lorem_ipsum.title(rng.randint(1, 4)).rstrip('.!?') for i in range(pool_size)]
+	slugs = [slugify(title) for title in titles]
+	bodies = [forgery_py.lorem_ipsum.sentences(quantity=100) for i in range(min(pool_size, 100))]
+	summaries = [Post.summarize(body) for body in bodies]
+	words = [forgery_py.lorem_ipsum.word() for i in range(pool_size)]
+	password_hash = generate_password_hash(password)
+
+	started = time.perf_counter()
+	count = _insert(User.__table__, (
+		{
+			'username': '%s%d' % (names[i % pool_size], i),
+			'email': '%s%d@%s' % (names[i % pool_size], i, domains[rng.randrange(pool_size)]),
+			'password_hash': password_hash,
+			'role_id': default_role.id
+		}
+		for i in range(users)
+	), batch_size)
+	availability.invalidate()
+	_report('users', count, started)
+
+	started = time.perf_counter()
+	author_ids = [row[0] for row in db.session.query(User.id)]
+	count = _insert(Post.__table__, (
+		{
+			'title': '%s %d' % (titles[i % pool_size], i),
+			'slug': '%s-%d' % (slugs[i % pool_size], i),
+			'body': bodies[b],
+			'summary': summaries[b][0],
+			'word_count': summaries[b][1],
+			'timestamp': EPOCH + timedelta(seconds=i * 60),
+			'date_modified': EPOCH + timedelta(seconds=i * 60),
+			'author_id': rng.choice(author_ids)
+		}
+		for i, b in ((i, rng.randrange(len(bodies))) for i in range(posts))
+	), batch_size)
+	search_index.rebuild()
+	db.session.commit()
+	_report('posts', count, started)
+
+	started = time.perf_counter()
+	count = _insert(Category.__table__, (
+		{
+			'priority': rng.randint(1, 100),
+			'display_name': '%s %d' % (words[i % pool_size], i),
+			'custom_template': False,
+			'custom_template_url': ''
+		}
+		for i in range(categories)
+	), batch_size)
+	# Every category after the first ten hangs below an earlier one
+	category_ids = [row[0] for row in db.session.query(Category.id).order_by(Category.id)]
+	_insert(category_tree_table, (
+		{'parent_id': category_ids[rng.randrange(i)], 'children_id': category_ids[i]}
+		for i in range(10, len(category_ids))
+	), batch_size)
+	Category.changed()
+	_report('categories', count, started)
+
+	started = time.perf_counter()
+	count = _insert(Tag.__table__, (
+		{'name': '%s%d' % (words[i % pool_size], i)} for i in range(tags)
+	), batch_size)
+	count += _insert(Permission.__table__, (
+		{'name': '%s%d' % (words[i % pool_size], i)} for i in range(permissions)
+	), batch_size)
+	_report('tags and permissions', count, started)
+
+	print('Done')
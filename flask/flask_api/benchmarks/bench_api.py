@@ -0,0 +1,260 @@
+import argparse
+import base64
+import contextlib
+import io
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import create_app, db, image_store, response_cache
+from app.models import User, Role, Post
+from app.seed import seed_bulk, SCALES
+
+
+'''
+Endpoint benchmarks for the api blueprint
+
+	python -m benchmarks.bench_api --scales tiny,small --requests 200
+	python -m benchmarks.bench_api --scales small --save	# store baseline
+	python -m benchmarks.bench_api --scales tiny --latency	# also compare p50 times
+
+Builds create_app('test') on a seeded SQLite file per scale and drives every
+route through the test client. Reports p50/p99 latency, requests/s, SQL
+queries per request (median, cache expiries add the odd extra one) and peak
+Python memory per request. Results are compared
+with benchmarks/baselines/<scale>.json when it exists: more queries per
+request than the baseline is a regression. Latency depends on the machine,
+so p50 is only shown next to the baseline unless --latency is given, for a
+baseline saved on the same machine.
+Routes behind the response cache run a second time with it off (name
+suffixed _uncached), the first pass only measures cache hits.
+Delete and revoke routes are left out, they would empty the dataset or log the
+benchmark out between runs. Edits write to fixed rows, looked up after
+seeding, and keep the values other requests depend on. Image variants are
+rendered inline (IMAGE_WORKERS = 0) so the upload time includes them.
+'''
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+ADMIN = 'Basic ' + base64.b64encode(b'admin@admin.admin:123456').decode()
+BULK_ITEMS = 10
+# Served from the response cache after the first request
+CACHED = ('get_post', 'get_category', 'list_categories', 'category_tree')
+
+queries = [0]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args):
+	queries[0] += 1
+
+
+def png():
+	from PIL import Image
+	output = io.BytesIO()
+	Image.new('RGB', (1200, 900), (200, 120, 40)).save(output, 'PNG')
+	return output.getvalue()
+
+
+def fixtures(app):
+	# Rows the edit and image routes work on
+	with app.app_context():
+		post = Post.query.order_by(Post.id).first()
+		fixed = {
+			'user_id': User.query.filter(User.username != 'admin').order_by(User.id).first().id,
+			'role_id': Role.query.filter_by(name='moderator').first().id,
+			'post_id': post.id,
+			'post_slug': post.slug,
+			'post_title': post.title,
+			'image': png()
+		}
+		fixed['image_path'] = image_store.save(fixed['image'])
+		db.session.remove()
+	return fixed
+
+
+def endpoints(fixed):
+	# name, method, url, authentication (True basic, 'token' bearer),
+	# body (callable gets a running number, bytes are sent as is, anything else as JSON)
+	return [
+		('testapi', 'GET', '/api/testapi/', False, None),
+		('test', 'GET', '/api/test', True, None),
+		('test_token', 'GET', '/api/test', 'token', None),
+		('test_anonymous', 'GET', '/api/test', False, None),
+		('new_token', 'POST', '/api/tokens/', True, None),
+		('load_user', 'POST', '/api/load_user/', False, lambda i: {'username': 'admin'}),
+		('list_usernames', 'GET', '/api/usernames/', True, None),
+		('list_users', 'GET', '/api/users/', True, None),
+		('list_roles', 'GET', '/api/roles/', True, None),
+		('list_posts', 'GET', '/api/posts/', True, None),
+		('list_posts_fields', 'GET', '/api/posts/?fields=title,slug,author', True, None),
+		('get_post', 'GET', '/api/posts/1', False, None),
+		('search_posts', 'GET', '/api/posts/search?q=lorem+ipsum', False, None),
+		('availability', 'GET', '/api/availability?username=admin&email=nobody@bench.bench', False, None),
+		('image_file', 'GET', '/api/images/' + fixed['image_path'], False, None),
+		('list_categories', 'GET', '/api/categories/', False, None),
+		('category_tree', 'GET', '/api/categories/tree', False, None),
+		('get_category', 'GET', '/api/categories/1', False, None),
+		('register', 'POST', '/api/register/', False, lambda i: {
+			'username': 'bench%d' % i, 'email': 'bench%d@bench.bench' % i, 'password': 'bench'}),
+		('new_post', 'POST', '/api/new_post/', True, lambda i: {
+			'title': 'Bench post %d' % i, 'body': 'Bench body %d' % i}),
+		('role_add', 'POST', '/api/roles/add/', True, lambda i: {'name': 'bench%d' % i}),
+		('add_category', 'POST', '/api/categories/add', True, lambda i: {'display_name': 'bench %d' % i}),
+		('bulk_users', 'POST', '/api/users/bulk', True, lambda i: [
+			{'username': 'bulk%d_%d' % (i, n), 'email': 'bulk%d_%d@bench.bench' % (i, n), 'password': 'bench'}
+			for n in range(BULK_ITEMS)]),
+		('bulk_posts', 'POST', '/api/posts/bulk', True, lambda i: [
+			{'title': 'Bulk post %d %d' % (i, n), 'body': 'Bulk body %d %d' % (i, n)}
+			for n in range(BULK_ITEMS)]),
+		('edit_user', 'POST', '/api/users/edit/', True, lambda i: {
+			'username': 'admin', 'email': 'admin@admin.admin'}),
+		('edit_user_admin', 'POST', '/api/users/admin/edit/%d/' % fixed['user_id'], True, lambda i: {
+			'username': 'edited%d' % i, 'email': 'edited%d@bench.bench' % i}),
+		('role_edit', 'POST', '/api/roles/edit/%d/' % fixed['role_id'], True, lambda i: {'name': 'moderator'}),
+		('edit_post', 'POST', '/api/edit_post/%s' % fixed['post_slug'], True, lambda i: {
+			'title': fixed['post_title'], 'body': 'Edited body %d' % i}),
+		('edit_category', 'POST', '/api/categories/edit/1', True, lambda i: {'priority': i % 100}),
+		('upload_image', 'POST', '/api/posts/%d/image' % fixed['post_id'], True, lambda i: fixed['image']),
+	]
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_endpoint(client, endpoint, requests, counter, credentials):
+	name, method, url, authentication, body = endpoint
+	headers = {'Authorization': credentials[authentication]} if authentication else {}
+
+	def call():
+		data = body(next(counter)) if body else None
+		if isinstance(data, bytes):
+			return client.open(url, method=method, headers=headers, data=data,
+				content_type='application/octet-stream')
+		return client.open(url, method=method, headers=headers, json=data)
+
+	for i in range(3):
+		call()
+
+	latencies = []
+	query_counts = []
+	statuses = set()
+	started = time.perf_counter()
+	for i in range(requests):
+		queries[0] = 0
+		t = time.perf_counter()
+		response = call()
+		latencies.append(time.perf_counter() - t)
+		query_counts.append(queries[0])
+		statuses.add(response.status_code)
+	elapsed = time.perf_counter() - started
+
+	tracemalloc.start()
+	call()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	return {
+		'status': sorted(statuses),
+		'p50_ms': percentile(latencies, 50) * 1000,
+		'p99_ms': percentile(latencies, 99) * 1000,
+		'rps': requests / elapsed,
+		'queries': statistics.median(query_counts),
+		'peak_kb': peak / 1024.0
+	}
+
+
+def run_scale(scale, requests):
+	directory = tempfile.mkdtemp(prefix='bench-api-')
+	app = create_app('test')
+	app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+	app.config['IMAGE_STORE_PATH'] = os.path.join(directory, 'images')
+	app.config['IMAGE_WORKERS'] = 0
+	image_store.init_app(app)
+	with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+		seed_bulk(**SCALES[scale])
+	fixed = fixtures(app)
+
+	client = app.test_client()
+	token = client.post('/api/tokens/', headers={'Authorization': ADMIN}).get_json()['token']
+	credentials = {True: ADMIN, 'token': 'Bearer ' + token}
+	counter = itertools.count()
+	results = {}
+	for endpoint in endpoints(fixed):
+		results[endpoint[0]] = run_endpoint(client, endpoint, requests, counter, credentials)
+
+	app.config['RESPONSE_CACHE_BACKEND'] = None
+	response_cache.init_app(app)
+	for endpoint in endpoints(fixed):
+		if endpoint[0] in CACHED:
+			name = endpoint[0] + '_uncached'
+			results[name] = run_endpoint(client, (name,) + endpoint[1:], requests, counter, credentials)
+	with app.app_context():
+		db.session.remove()
+		db.get_engine(app).dispose()
+	return results
+
+
+def report(scale, results, baseline, threshold, latency=False):
+	print('\n== %s ==' % scale)
+	print('%-24s %-10s %9s %9s %9s %8s %10s  %s' % (
+		'endpoint', 'status', 'p50 ms', 'p99 ms', 'req/s', 'queries', 'peak KB', 'vs baseline p50'))
+	regressions = []
+	for name, r in results.items():
+		delta = ''
+		if baseline and name in baseline:
+			ratio = r['p50_ms'] / baseline[name]['p50_ms'] if baseline[name]['p50_ms'] else 1.0
+			delta = '%+.0f%%' % ((ratio - 1) * 100)
+			if r['queries'] > baseline[name]['queries'] or (latency and ratio > threshold):
+				delta += '  REGRESSION'
+				regressions.append(name)
+		print('%-24s %-10s %9.2f %9.2f %9.0f %8.1f %10.1f  %s' % (
+			name, ','.join(map(str, r['status'])), r['p50_ms'], r['p99_ms'],
+			r['rps'], r['queries'], r['peak_kb'], delta))
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the api blueprint endpoints')
+	parser.add_argument('--scales', default='tiny,small', help=', '.join(SCALES))
+	parser.add_argument('--requests', type=int, default=100, help='timed requests per endpoint')
+	parser.add_argument('--save', action='store_true', help='store results as the new baseline')
+	parser.add_argument('--latency', action='store_true', help='count p50 over threshold as a regression')
+	parser.add_argument('--threshold', type=float, default=1.25, help='p50 ratio counted as regression with --latency')
+	args = parser.parse_args(argv)
+
+	regressions = []
+	for scale in args.scales.split(','):
+		path = os.path.join(BASELINES, '%s.json' % scale)
+		baseline = None
+		if os.path.exists(path):
+			with open(path) as f:
+				baseline = json.load(f)
+
+		results = run_scale(scale, args.requests)
+		regressions += ['%s/%s' % (scale, name) for name in report(scale, results, baseline, args.threshold, args.latency)]
+
+		if args.save:
+			os.makedirs(BASELINES, exist_ok=True)
+			with open(path, 'w') as f:
+				json.dump(results, f, indent=2, sort_keys=True)
+			print('Saved baseline %s' % path)
+
+	if regressions:
+		print('\nRegressions: %s' % ', '.join(regressions))
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The production profile needs one, read when config.py is imported
+os.environ.setdefault('SECRET_KEY', 'bench-' + os.urandom(16).hex())
+
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import Post
+from app.seed import seed_bulk, SCALES
+from benchmarks.bench_api import percentile
+
+
+'''
+Concurrent read/write throughput per config profile
+
+	python -m benchmarks.bench_concurrency --profiles test,production --readers 8 --writers 2
+
+Seeds a fresh SQLite file per profile, then reader threads load random posts
+while writer threads update them, each in its own app context and session.
+With the test profile (rollback journal, no pool) writers block readers and
+fail with "database is locked"; the production profile (WAL, pooled
+connections, busy_timeout) should show more reads/s and no lock errors.
+'''
+
+
+class Counter:
+	def __init__(self):
+		self.done = 0
+		self.errors = 0
+		self.latencies = []
+
+
+def worker(app, post_ids, until, counter, write):
+	rng = random.Random()
+	with app.app_context():
+		while time.perf_counter() < until:
+			t = time.perf_counter()
+			try:
+				post = db.session.query(Post).get(rng.choice(post_ids))
+				if write:
+					post.body = 'Benchmark body %d' % rng.random()
+					post.date_modified = datetime.utcnow()
+					db.session.commit()
+				else:
+					post.to_json()
+					db.session.rollback()
+			except OperationalError:
+				db.session.rollback()
+				counter.errors += 1
+				continue
+			counter.latencies.append(time.perf_counter() - t)
+			counter.done += 1
+		db.session.remove()
+
+
+def run_profile(profile, scale, readers, writers, seconds):
+	directory = tempfile.mkdtemp(prefix='bench-concurrency-')
+	app = create_app(profile)
+	app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+	with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+		seed_bulk(**SCALES[scale])
+		post_ids = [row[0] for row in db.session.query(Post.id)]
+		db.session.remove()
+
+	until = time.perf_counter() + seconds
+	reads = [Counter() for i in range(readers)]
+	writes = [Counter() for i in range(writers)]
+	threads = [threading.Thread(target=worker, args=(app, post_ids, until, c, False)) for c in reads]
+	threads += [threading.Thread(target=worker, args=(app, post_ids, until, c, True)) for c in writes]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	with app.app_context():
+		db.get_engine(app).dispose()
+
+	def summary(counters):
+		latencies = [l for c in counters for l in c.latencies]
+		return {
+			'ops': sum(c.done for c in counters) / float(seconds),
+			'errors': sum(c.errors for c in counters),
+			'p99_ms': percentile(latencies, 99) * 1000 if latencies else 0.0
+		}
+
+	return summary(reads), summary(writes)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Concurrent read/write throughput per config profile')
+	parser.add_argument('--profiles', default='test,production')
+	parser.add_argument('--scale', default='tiny', help=', '.join(SCALES))
+	parser.add_argument('--readers', type=int, default=8)
+	parser.add_argument('--writers', type=int, default=2)
+	parser.add_argument('--seconds', type=float, default=5.0)
+	args = parser.parse_args(argv)
+
+	print('%-12s %10s %8s %9s %10s %8s %9s' % (
+		'profile', 'reads/s', 'errors', 'p99 ms', 'writes/s', 'errors', 'p99 ms'))
+	for profile in args.profiles.split(','):
+		reads, writes = run_profile(profile, args.scale, args.readers, args.writers, args.seconds)
+		print('%-12s %10.0f %8d %9.2f %10.0f %8d %9.2f' % (
+			profile, reads['ops'], reads['errors'], reads['p99_ms'],
+			writes['ops'], writes['errors'], writes['p99_ms']))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,87 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import json as flask_json
+from app import create_app, db
+from app.api import encoders
+from app.api.serializers import dump_posts, dump_users, post_options, user_options
+from app.models import User, Post
+from app.seed import seed_bulk, SCALES
+
+
+'''
+Response encoder comparison
+
+	python -m benchmarks.bench_encoders --scale small --limit 500
+
+Builds the list_posts and list_users page payloads once, then times each
+encoder on them. "jsonify" is flask.json.dumps, what the views used before
+(sorted keys, stdlib encoder). orjson and msgpack rows show up when the
+packages are installed.
+'''
+
+
+def candidates():
+	rows = [
+		('jsonify', lambda data: flask_json.dumps(data).encode('utf-8')),
+		('json', lambda data: flask_json.dumps(data, sort_keys=False, separators=(',', ':')).encode('utf-8')),
+	]
+	if encoders.orjson is not None:
+		rows.append(('orjson', encoders.orjson.dumps))
+	if encoders.msgpack is not None:
+		rows.append(('msgpack', encoders.encode_msgpack))
+	return rows
+
+
+def time_encoder(encode, data, rounds):
+	encode(data)
+	started = time.perf_counter()
+	for i in range(rounds):
+		body = encode(data)
+	return (time.perf_counter() - started) / rounds, len(body)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Compare response encoders on list payloads')
+	parser.add_argument('--scale', default='small', help=', '.join(SCALES))
+	parser.add_argument('--limit', type=int, default=500, help='items per page')
+	parser.add_argument('--rounds', type=int, default=20)
+	args = parser.parse_args(argv)
+
+	app = create_app('test')
+	app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+		tempfile.mkdtemp(prefix='bench-encoders-'), 'bench.sqlite'
+	)
+	with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+		seed_bulk(**SCALES[args.scale])
+
+	with app.test_request_context():
+		payloads = [
+			('list_posts', {'items': dump_posts(
+				Post.query.options(*post_options()).order_by(Post.id).limit(args.limit).all()
+			), 'next': None}),
+			('list_users', {'items': dump_users(
+				User.query.options(*user_options()).order_by(User.id).limit(args.limit).all()
+			), 'next': None}),
+		]
+		db.session.remove()
+
+		print('%-12s %-10s %10s %10s %8s' % ('payload', 'encoder', 'ms', 'bytes', 'speedup'))
+		for name, data in payloads:
+			base = None
+			for encoder, encode in candidates():
+				seconds, size = time_encoder(encode, data, args.rounds)
+				base = base or seconds
+				print('%-12s %-10s %10.2f %10d %7.1fx' % (name, encoder, seconds * 1000, size, base / seconds))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -6,14 +6,100 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = 'asdf'
 
+    # Verified Basic-auth credentials, skips password hashing on repeat calls
+    CREDENTIAL_CACHE_SIZE = 1024
+    CREDENTIAL_CACHE_TTL = 300
+
+    # Lifetime of signed tokens from /api/tokens/, seconds
+    API_TOKEN_TTL = 3600
+
+    # Post images: store directory (None for instance/images), public URL prefix,
+    # variant name -> bounding box, worker processes (0 renders in the request)
+    IMAGE_STORE_PATH = None
+    IMAGE_URL = '/api/images/'
+    IMAGE_VARIANTS = {'thumb': (160, 160), 'medium': (800, 800)}
+    IMAGE_WORKERS = 2
+    IMAGE_MAX_BYTES = 10 * 1024 * 1024
+    # Content addressed files never change
+    IMAGE_CACHE_SECONDS = 365 * 24 * 3600
+
+    # Username/email Bloom filters: minimum entries, false positive rate,
+    # seconds before a rebuild picks up users written by other processes
+    AVAILABILITY_CAPACITY = 100000
+    AVAILABILITY_ERROR_RATE = 0.01
+    AVAILABILITY_REFRESH = 300
+
+    # Public GET responses: 'lru' (per process), 'redis' (shared, RESPONSE_CACHE_URL) or None
+    RESPONSE_CACHE_BACKEND = 'lru'
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 60
+    RESPONSE_CACHE_URL = 'redis://localhost:6379/0'
+
+    # Keyset pagination for list endpoints
+    API_PAGE_SIZE = 50
+    API_MAX_PAGE_SIZE = 500
+
+    # Rows per batch for streamed exports
+    API_STREAM_BATCH_SIZE = 500
+
+    # Bulk create: items per request, items per conflict query, password hashing threads
+    API_BULK_MAX_ITEMS = 10000
+    API_BULK_QUERY_CHUNK = 1000
+    API_BULK_HASH_WORKERS = 4
+
+    # Server-Timing header with db/serialize/total times on every response
+    METRICS_SERVER_TIMING = False
+
+    # Post search: 'fts5' (SQLite) or 'like', None picks from the database URI
+    SEARCH_BACKEND = None
+
+    # Run on every new SQLite connection, see app/database.py
+    SQLITE_PRAGMAS = None
+
+    # Replica URIs for views marked @db.read_replica, writes stay on the primary.
+    # Local test with SQLite files: python manage.py sync_replicas
+    READ_REPLICAS = []
+
 
 class TestConfig(Config):
     DEBUG = True
+    METRICS_SERVER_TIMING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
         basedir, 'data-test.sqlite'
     )
 
 
+class ProductionConfig(Config):
+    # Signs sessions, API tokens and the credential cache, create_app refuses to start without it
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(
+        basedir, 'data.sqlite'
+    )
+
+    # Connection pool, for SQLite a QueuePool of open connections
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+        'pool_timeout': 30,
+        'pool_recycle': 1800,  # Below MySQL wait_timeout
+        'pool_pre_ping': True
+    }
+
+    # Comma separated, e.g. mysql://reader@replica1/blog,mysql://reader@replica2/blog
+    READ_REPLICAS = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+
+    # WAL lets readers run during a write, NORMAL syncs at checkpoints only.
+    # mmap_size in bytes, negative cache_size in KiB, busy_timeout in ms.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'busy_timeout': 5000
+    }
+
+
 config = {
-    'test': TestConfig
+    'test': TestConfig,
+    'production': ProductionConfig
 }
@@ -1,5 +1,7 @@
 from app import create_app, db
+from app.database import copy_sqlite
 from app.models import User, Role, Post, Category, Tag, generate_fake_data
+from app.seed import seed_bulk, SCALES
 from flask_migrate import Migrate, upgrade, MigrateCommand
 from flask_script import Manager, Shell, Server
 
@@ -14,7 +16,7 @@ server = Server(host='0.0.0.0', port=5000)
 def make_shell_context():
     return dict(
         app=app, db=db, User=User, Role=Role, Post=Post, Category=Category, Tag=Tag,
-        generate_fake_data=generate_fake_data
+        generate_fake_data=generate_fake_data, seed_bulk=seed_bulk
     )
 
 
@@ -23,6 +25,31 @@ manager.add_command("runserver", server)
 manager.add_command("db", MigrateCommand)
 
 
+# Bulk fake data for load testing: python manage.py seed --scale medium --seed 1
+@manager.option('--scale', dest='scale', default='small', help=', '.join(SCALES))
+@manager.option('--seed', dest='seed', default=0, type=int)
+@manager.option('--batch-size', dest='batch_size', default=10000, type=int)
+def seed(scale, seed, batch_size):
+    seed_bulk(seed=seed, batch_size=batch_size, **SCALES[scale])
+
+
+# Post summaries for rows written before the summary column existed
+@manager.option('--batch-size', dest='batch_size', default=1000, type=int)
+def backfill_summaries(batch_size):
+    print('%d posts updated' % Post.backfill_summaries(batch_size))
+
+
+# Local read replicas: copy the SQLite primary over every SQLite READ_REPLICAS file
+@manager.command
+def sync_replicas():
+    primary = db.get_engine(app).url.database
+    for i in range(len(app.config['READ_REPLICAS'])):
+        replica = db.get_engine(app, bind='replica%d' % i).url
+        if replica.drivername == 'sqlite':
+            copy_sqlite(primary, replica.database)
+            print('Copied to %s' % replica.database)
+
+
 # HTTPIE (if self signed certificate): https --verify=no
 if __name__ == '__main__':
     manager.run()
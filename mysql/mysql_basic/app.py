@@ -1,29 +1,24 @@
 import mysql.connector
 import datetime
+from config import config
+from ingest import ConnectionPool, SensorBuffer, SensorWriter
 
-mydb = mysql.connector.connect(
-    host="localhost",
-    user="root",
-    password="!1234Asdf",
-    database="3elda"
-)
-
-mycursor = mydb.cursor()
+pool = ConnectionPool(lambda: mysql.connector.connect(**config), size=2)
+buffer = SensorBuffer(SensorWriter(pool), max_size=1000, max_age=1.0)
 
 print("Connected..")
 
-sql = "INSERT INTO sensor(verdi,tid) VALUES (%s,%s)"
-
 verdi = 5.0
 tid = datetime.datetime.now()
 
-val = (verdi, tid)
-
 print("Executing...")
 
-mycursor.execute(sql, val)
-mydb.commit()
+# Buffered, written with executemany when the buffer is full or a second old
+buffer.add(verdi, tid)
+buffer.close()
+pool.close()
 
+print(buffer.stats())
 print("Done")
 
 '''
@@ -0,0 +1,6 @@
+config = dict(
+    host="localhost",
+    user="root",
+    password="!1234Asdf",
+    database="3elda"
+)
@@ -0,0 +1,220 @@
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+'''
+    Buffered sensor ingestion:
+
+    Readings go into an in-memory buffer. A background thread writes the
+    buffer with one executemany in one transaction when it holds max_size
+    rows or its oldest row is max_age seconds old. Connections come from a
+    small pool, so a flush doesn't pay for a new connection.
+
+        pool = ConnectionPool(lambda: mysql.connector.connect(**config), size=4)
+        buffer = SensorBuffer(SensorWriter(pool), max_size=1000, max_age=1.0)
+        buffer.add(5.0)
+        ...
+        buffer.close()
+
+    For local testing use sqlite_pool('sensor.sqlite') with placeholder='?'.
+'''
+
+INSERT_SQL = "INSERT INTO sensor(verdi,tid) VALUES ({0},{0})"
+
+
+class ConnectionPool:
+    """Fixed size pool, get() blocks while every connection is in use."""
+
+    def __init__(self, connect, size=4):
+        self._connections = queue.Queue()
+        for i in range(size):
+            self._connections.put(connect())
+
+    def get(self):
+        return self._connections.get()
+
+    def put(self, connection):
+        self._connections.put(connection)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+def sqlite_pool(path, size=4):
+    """Pool of SQLite connections with the sensor table, stand-in for MySQL."""
+    def connect():
+        connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS sensor (verdi REAL, tid TIMESTAMP)")
+        connection.commit()
+        return connection
+    return ConnectionPool(connect, size)
+
+
+class SensorWriter:
+    """Writes a batch of (verdi, tid) rows in one transaction."""
+
+    def __init__(self, pool, placeholder='%s'):
+        self.pool = pool
+        self.sql = INSERT_SQL.format(placeholder)
+
+    def write(self, rows):
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            cursor.executemany(self.sql, rows)
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.put(connection)
+
+
+class SensorBuffer:
+    def __init__(self, writer, max_size=1000, max_age=1.0):
+        self.writer = writer
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self._rows = []
+        self._oldest = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self.rows_written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self._started = time.perf_counter()
+
+        self._thread = threading.Thread(target=self._run, name='sensor-flush', daemon=True)
+        self._thread.start()
+
+    def add(self, verdi, tid=None):
+        if tid is None:
+            tid = datetime.datetime.now()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('SensorBuffer is closed')
+            if not self._rows:
+                # Wakes the flusher to start its max_age timer
+                self._oldest = time.monotonic()
+                self._condition.notify()
+            self._rows.append((verdi, tid))
+            if len(self._rows) >= self.max_size:
+                self._condition.notify()
+
+    def add_many(self, readings):
+        for verdi, tid in readings:
+            self.add(verdi, tid)
+
+    def depth(self):
+        with self._condition:
+            return len(self._rows)
+
+    def flush(self):
+        """Write whatever is buffered now, in the calling thread."""
+        with self._condition:
+            rows = self._take()
+        self._write(rows)
+
+    def close(self, retries=3):
+        """Flush and stop, RuntimeError if readings are still unwritten after retries."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        for i in range(retries):
+            if not self.depth():
+                return
+            time.sleep(self.max_age)
+            self.flush()
+        if self.depth():
+            raise RuntimeError('%d readings not written' % self.depth())
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started
+        return {
+            'rows_written': self.rows_written,
+            'rows_per_second': self.rows_written / elapsed if elapsed else 0.0,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'avg_flush_ms': self.flush_seconds / self.flushes * 1000 if self.flushes else 0.0,
+            'last_flush_ms': self.last_flush_seconds * 1000,
+            'buffer_depth': self.depth()
+        }
+
+    def _take(self):
+        rows, self._rows = self._rows, []
+        self._oldest = None
+        return rows
+
+    def _due(self):
+        if len(self._rows) >= self.max_size:
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+
+    def _write(self, rows):
+        if not rows:
+            return True
+        started = time.perf_counter()
+        try:
+            self.writer.write(rows)
+        except Exception as e:
+            # Keep the rows, they go out with the next flush
+            self.errors += 1
+            print('Flush of %d rows failed: %s' % (len(rows), e))
+            with self._condition:
+                self._rows[:0] = rows
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            return False
+        self.last_flush_seconds = time.perf_counter() - started
+        self.flush_seconds += self.last_flush_seconds
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._due():
+                    if self._oldest is None:
+                        timeout = None
+                    else:
+                        timeout = max(0.0, self.max_age - (time.monotonic() - self._oldest))
+                    self._condition.wait(timeout)
+                closed = self._closed
+                rows = self._take()
+            written = self._write(rows)
+            if closed:
+                break
+            if not written:
+                time.sleep(self.max_age)  # Database is down, don't spin
+
+
+if __name__ == '__main__':
+    # Local run against SQLite: python ingest.py 100000
+    import os
+    import sys
+    import tempfile
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = os.path.join(tempfile.mkdtemp(), 'sensor.sqlite')
+    pool = sqlite_pool(path)
+    buffer = SensorBuffer(SensorWriter(pool, placeholder='?'), max_size=5000, max_age=0.5)
+
+    started = time.perf_counter()
+    for i in range(count):
+        buffer.add(20.0 + (i % 100) / 10.0)
+    buffer.close()
+    elapsed = time.perf_counter() - started
+
+    print('%d readings in %.2fs (%.0f readings/s)' % (count, elapsed, count / elapsed))
+    print(buffer.stats())
+    pool.close()
@@ -0,0 +1,257 @@
+import datetime
+from ingest import SensorWriter
+
+'''
+    Time-series rollups for the sensor table:
+
+    sensor_minute, sensor_hour and sensor_day hold count/sum/min/max per
+    bucket. RollupWriter updates them in the same transaction as the raw
+    insert, so they are always in step with sensor. query_range() answers a
+    range query from the coarsest table that still gives the requested
+    resolution, e.g. a week at 1 hour resolution reads 168 rows instead of
+    every raw reading.
+
+        pool = ConnectionPool(lambda: mysql.connector.connect(**config))
+        create_rollup_tables(pool)
+        buffer = SensorBuffer(RollupWriter(pool), max_size=1000)
+        ...
+        query_range(pool, start, end, resolution=3600)
+'''
+
+# (table, bucket size in seconds), finest first
+LEVELS = [
+    ('sensor_minute', 60),
+    ('sensor_hour', 3600),
+    ('sensor_day', 86400),
+]
+
+CREATE_SQL = """CREATE TABLE IF NOT EXISTS {0} (
+    bucket DATETIME NOT NULL PRIMARY KEY,
+    n BIGINT NOT NULL,
+    total DOUBLE NOT NULL,
+    min_verdi DOUBLE NOT NULL,
+    max_verdi DOUBLE NOT NULL
+)"""
+
+UPSERT_SQL = {
+    'mysql': """INSERT INTO {0} (bucket, n, total, min_verdi, max_verdi)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            n = n + VALUES(n),
+            total = total + VALUES(total),
+            min_verdi = LEAST(min_verdi, VALUES(min_verdi)),
+            max_verdi = GREATEST(max_verdi, VALUES(max_verdi))""",
+    'sqlite': """INSERT INTO {0} (bucket, n, total, min_verdi, max_verdi)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(bucket) DO UPDATE SET
+            n = n + excluded.n,
+            total = total + excluded.total,
+            min_verdi = MIN(min_verdi, excluded.min_verdi),
+            max_verdi = MAX(max_verdi, excluded.max_verdi)""",
+}
+
+# Rebuild straight from sensor, {1} is the bucket start of tid
+REBUILD_SQL = """INSERT INTO {0} (bucket, n, total, min_verdi, max_verdi)
+    SELECT {1}, COUNT(*), SUM(verdi), MIN(verdi), MAX(verdi)
+    FROM sensor GROUP BY 1"""
+
+# Bucket size -> bucket start expression, same buckets as truncate()
+BUCKET_SQL = {
+    'mysql': {
+        60: "DATE_FORMAT(tid, '%Y-%m-%d %H:%i:00')",
+        3600: "DATE_FORMAT(tid, '%Y-%m-%d %H:00:00')",
+        86400: "DATE_FORMAT(tid, '%Y-%m-%d 00:00:00')",
+    },
+    'sqlite': {
+        60: "strftime('%Y-%m-%d %H:%M:00', tid)",
+        3600: "strftime('%Y-%m-%d %H:00:00', tid)",
+        86400: "strftime('%Y-%m-%d 00:00:00', tid)",
+    },
+}
+
+PLACEHOLDER = {
+    'mysql': '%s',
+    'sqlite': '?',
+}
+
+
+def truncate(tid, seconds):
+    """Start of the bucket of the given size that tid falls in."""
+    if seconds >= 86400:
+        return tid.replace(hour=0, minute=0, second=0, microsecond=0)
+    if seconds >= 3600:
+        return tid.replace(minute=0, second=0, microsecond=0)
+    if seconds >= 60:
+        return tid.replace(second=0, microsecond=0)
+    return tid.replace(microsecond=0)
+
+
+def as_datetime(value):
+    # SQLite hands DATETIME columns back as text
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def aggregate(rows, seconds):
+    """{bucket: [n, total, min, max]} for (verdi, tid) rows."""
+    buckets = {}
+    for verdi, tid in rows:
+        key = truncate(as_datetime(tid), seconds)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, verdi, verdi, verdi]
+        else:
+            bucket[0] += 1
+            bucket[1] += verdi
+            bucket[2] = min(bucket[2], verdi)
+            bucket[3] = max(bucket[3], verdi)
+    return buckets
+
+
+def create_rollup_tables(pool):
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        for table, seconds in LEVELS:
+            cursor.execute(CREATE_SQL.format(table))
+        connection.commit()
+        cursor.close()
+    finally:
+        pool.put(connection)
+
+
+class RollupWriter(SensorWriter):
+    """Raw insert plus rollup upserts, one transaction per batch."""
+
+    def __init__(self, pool, dialect='mysql'):
+        super().__init__(pool, placeholder=PLACEHOLDER[dialect])
+        self.dialect = dialect
+
+    def write(self, rows):
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            cursor.executemany(self.sql, rows)
+            self._upsert(cursor, rows)
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.put(connection)
+
+    def rebuild(self):
+        """Recompute every rollup from the raw sensor table, in the database."""
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            for table, seconds in LEVELS:
+                cursor.execute("DELETE FROM %s" % table)
+                cursor.execute(REBUILD_SQL.format(table, BUCKET_SQL[self.dialect][seconds]))
+            connection.commit()
+            cursor.close()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self.pool.put(connection)
+
+    def _upsert(self, cursor, rows):
+        sql = UPSERT_SQL[self.dialect]
+        for table, seconds in LEVELS:
+            buckets = aggregate(rows, seconds)
+            cursor.executemany(sql.format(table), [
+                (bucket, n, total, low, high)
+                for bucket, (n, total, low, high) in sorted(buckets.items())
+            ])
+
+
+def merge(buckets, origin, resolution):
+    """Fold (bucket, [n, total, min, max]) pairs into buckets of resolution seconds from origin."""
+    merged = {}
+    for bucket, (n, total, low, high) in buckets:
+        offset = (bucket - origin).total_seconds() // resolution
+        key = origin + datetime.timedelta(seconds=offset * resolution)
+        current = merged.get(key)
+        if current is None:
+            merged[key] = [n, total, low, high]
+        else:
+            current[0] += n
+            current[1] += total
+            current[2] = min(current[2], low)
+            current[3] = max(current[3], high)
+    return merged
+
+
+def query_range(pool, start, end, resolution=60, dialect='mysql'):
+    """
+        Readings between start and end grouped in buckets of resolution
+        seconds: [{'bucket', 'count', 'min', 'max', 'avg'}, ...]
+        Read from the coarsest rollup whose bucket size divides resolution,
+        buckets then start at start truncated to that size.
+    """
+    placeholder = PLACEHOLDER[dialect]
+    level = None
+    for table, seconds in LEVELS:
+        if seconds <= resolution and resolution % seconds == 0:
+            level = (table, seconds)
+
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        if level is None:
+            # Not a whole number of minutes, only the raw table has it
+            origin = truncate(start, 1)
+            cursor.execute(
+                "SELECT verdi, tid FROM sensor WHERE tid >= {0} AND tid < {0}".format(placeholder),
+                (start, end)
+            )
+            buckets = aggregate(cursor.fetchall(), 1).items()
+        else:
+            table, seconds = level
+            origin = truncate(start, seconds)
+            cursor.execute(
+                "SELECT bucket, n, total, min_verdi, max_verdi FROM {0} "
+                "WHERE bucket >= {1} AND bucket < {1} ORDER BY bucket".format(table, placeholder),
+                (origin, end)
+            )
+            buckets = [(as_datetime(row[0]), row[1:]) for row in cursor.fetchall()]
+        cursor.close()
+    finally:
+        pool.put(connection)
+
+    return [
+        {'bucket': bucket, 'count': n, 'min': low, 'max': high, 'avg': total / n}
+        for bucket, (n, total, low, high) in sorted(merge(buckets, origin, resolution).items())
+    ]
+
+
+if __name__ == '__main__':
+    # Local run against SQLite: python rollup.py 100000
+    import os
+    import sys
+    import tempfile
+    import time
+    from ingest import SensorBuffer, sqlite_pool
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    pool = sqlite_pool(os.path.join(tempfile.mkdtemp(), 'sensor.sqlite'))
+    create_rollup_tables(pool)
+    buffer = SensorBuffer(RollupWriter(pool, dialect='sqlite'), max_size=5000, max_age=0.5)
+
+    # One reading every 6 seconds from the start of 2020
+    first = datetime.datetime(2020, 1, 1)
+    for i in range(count):
+        buffer.add(20.0 + (i % 100) / 10.0, first + datetime.timedelta(seconds=6 * i))
+    buffer.close()
+    print(buffer.stats())
+
+    last = first + datetime.timedelta(seconds=6 * count)
+    for resolution in (10, 60, 3600, 6 * 3600, 86400):
+        started = time.perf_counter()
+        result = query_range(pool, first, last, resolution, dialect='sqlite')
+        print('resolution %6ds: %5d buckets in %.1f ms' % (
+            resolution, len(result), (time.perf_counter() - started) * 1000))
+    pool.close()
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import tempfile
+import time
+from ingest import SensorWriter, sqlite_pool
+
+'''
+    Sensor ingestion server:
+
+    Producers connect over TCP and send one reading per line:
+
+        21.5
+        21.5 2020-01-01T12:00:00
+
+    Readings go through a bounded queue to writer tasks that batch them and
+    write with executemany in a worker thread. When the database is slow the
+    queue fills up, connection handlers then wait on queue.put() and stop
+    reading their sockets, so producers are slowed down by TCP instead of the
+    server running out of memory. Send "STATS" on a connection to get the
+    counters back as one JSON line.
+
+    Values must be finite and timestamps naive (local time, like tid). A
+    batch that still fails after retries attempts is dropped so it can't
+    stop ingestion; with dead_letter set its readings are appended to that
+    file in the line format above, ready to be sent again.
+
+        python server.py --sqlite sensor.sqlite --port 9000
+        python server.py --demo
+'''
+
+
+class IngestServer:
+    def __init__(self, writer, queue_size=10000, batch_size=1000, max_age=0.5, writers=2,
+                 retries=5, dead_letter=None):
+        self.writer = writer
+        self.retries = retries
+        self.dead_letter = dead_letter
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.writers = writers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+        self.received = 0
+        self.rejected = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.blocked_puts = 0
+        self._started = time.perf_counter()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._write_loop()) for i in range(self.writers)]
+
+    async def drain(self):
+        """Wait until everything queued so far is written."""
+        await self.queue.join()
+
+    async def stop(self):
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'written': self.written,
+            'rows_per_second': self.written / elapsed if elapsed else 0.0,
+            'batches': self.batches,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'queue_depth': self.queue.qsize(),
+            'blocked_puts': self.blocked_puts,
+            'avg_queue_ms': self.queue_seconds / self.written * 1000 if self.written else 0.0,
+            'max_queue_ms': self.max_queue_seconds * 1000
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                if line == 'STATS':
+                    writer.write((json.dumps(self.stats()) + '\n').encode('utf-8'))
+                    await writer.drain()
+                    continue
+                reading = self.parse(line)
+                if reading is None:
+                    self.rejected += 1
+                    continue
+                self.received += 1
+                if self.queue.full():
+                    self.blocked_puts += 1
+                await self.queue.put(reading + (time.monotonic(),))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def parse(line):
+        parts = line.split(None, 1)
+        try:
+            verdi = float(parts[0])
+            if len(parts) > 1:
+                tid = datetime.datetime.fromisoformat(parts[1])
+            else:
+                tid = datetime.datetime.now()
+        except ValueError:
+            return None
+        if not math.isfinite(verdi) or tid.tzinfo is not None:
+            return None  # nan/inf, or an aware timestamp the naive column can't hold
+        return verdi, tid
+
+    async def _next_batch(self):
+        # Wait for one reading, then collect more until batch_size or max_age
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_age
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            rows = [(verdi, tid) for verdi, tid, queued in batch]
+            written = False
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    # Producers wait on the full queue meanwhile
+                    await asyncio.sleep(self.max_age)
+                try:
+                    await loop.run_in_executor(None, self.writer.write, rows)
+                    written = True
+                    break
+                except Exception as e:
+                    self.errors += 1
+                    print('Write of %d rows failed: %s' % (len(rows), e))
+            if written:
+                now = time.monotonic()
+                for verdi, tid, queued in batch:
+                    waited = now - queued
+                    self.queue_seconds += waited
+                    if waited > self.max_queue_seconds:
+                        self.max_queue_seconds = waited
+                self.written += len(rows)
+                self.batches += 1
+            else:
+                await loop.run_in_executor(None, self._drop, rows)
+            for i in range(len(batch)):
+                self.queue.task_done()
+
+    def _drop(self, rows):
+        self.dropped += len(rows)
+        print('Dropped %d rows after %d retries' % (len(rows), self.retries))
+        if self.dead_letter:
+            with open(self.dead_letter, 'a') as f:
+                for verdi, tid in rows:
+                    f.write('%r %s\n' % (verdi, tid.isoformat()))
+
+
+async def serve(ingest, host='127.0.0.1', port=9000):
+    ingest.start()
+    return await asyncio.start_server(ingest.handle, host, port)
+
+
+async def demo(producers=50, readings=2000):
+    # Many concurrent producers against a local SQLite file
+    path = os.path.join(tempfile.mkdtemp(), 'sensor.sqlite')
+    pool = sqlite_pool(path, size=2)
+    ingest = IngestServer(SensorWriter(pool, placeholder='?'), queue_size=5000)
+    server = await serve(ingest, port=0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def produce(n):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for i in range(readings):
+            writer.write(('%.1f\n' % (n + i / 100.0)).encode('utf-8'))
+            await writer.drain()
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(produce(n) for n in range(producers)))
+    while ingest.written < producers * readings:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    print('%d readings from %d producers in %.2fs' % (producers * readings, producers, elapsed))
+    print(ingest.stats())
+    server.close()
+    await server.wait_closed()
+    await ingest.stop()
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sensor ingestion server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--sqlite', help='write to this SQLite file instead of MySQL')
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dead-letter', help='append readings of batches that keep failing to this file')
+    parser.add_argument('--demo', action='store_true', help='run local producers and print stats')
+    args = parser.parse_args()
+
+    if args.demo:
+        asyncio.run(demo())
+        return
+
+    if args.sqlite:
+        writer = SensorWriter(sqlite_pool(args.sqlite, size=2), placeholder='?')
+    else:
+        import mysql.connector
+        from config import config
+        from ingest import ConnectionPool
+        writer = SensorWriter(ConnectionPool(lambda: mysql.connector.connect(**config), size=2))
+
+    async def run():
+        ingest = IngestServer(writer, queue_size=args.queue_size, batch_size=args.batch_size,
+                              dead_letter=args.dead_letter)
+        server = await serve(ingest, args.host, args.port)
+        print('Listening on %s:%d' % (args.host, args.port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()